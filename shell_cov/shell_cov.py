@@ -1,20 +1,87 @@
 import argparse
+import asyncio
+import fnmatch
+import hashlib
+import io
+import json
 import os
 import re
+import mmap
+import shutil
+import signal
+import socket
+import socketserver
+import stat
 import subprocess  # nosec
+import struct
 import sys
-from itertools import groupby
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from itertools import chain, groupby
 from pathlib import Path
 from operator import itemgetter
 from re import DOTALL, MULTILINE, VERBOSE
 from typing import Dict, List, Union
+from xml.sax.saxutils import quoteattr
 
 VERSION = '0.0.0'
 
-DEFAULT_PS4 = '+PS4 + ${BASH_SOURCE} + ${SECONDS}S + L${LINENO} + '
+# The clock is $EPOCHREALTIME (bash 5+) if set, as $SECONDS is only whole seconds
+DEFAULT_PS4 = '+PS4 + ${BASH_SOURCE} + ${EPOCHREALTIME:-$SECONDS}S + L${LINENO} + '
 FILLER = '@@filler@@'
 BASE_CMD = ['/bin/sh', '-x']
+# BASH_XTRACEFD is a bash (>= 4.1) feature
+BASH_CMD = ['/bin/bash', '-x']
+STDOUT_TAIL_LINES = 20
+# Seconds between reports of which tests are still running
+PROGRESS_INTERVAL = 10
+# Bytes of a test's trace read at a time by the asyncio runner
+TRACE_CHUNK_SIZE = 64 * 1024
+RUNNERS = ('threads', 'asyncio')
+# Seconds to read the rest of a killed test's trace
+KILL_GRACE = 1
+BINARY_MAGIC = b'\x89SHELLCOV\n'
+BINARY_FORMAT_VERSION = 1
+_FORMAT_VERSION = struct.Struct('<H')
+_SECTION_LENGTH = struct.Struct('<Q')
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+# Part of the --cache-dir key. Bump it whenever a change to the parsers
+# changes the lines they find, so older cached results are not reused.
+PARSER_REVISION = 1
+ENGINES = ('regex', 'lexer')
+# Bytes of a trace file mapped at once, a multiple of mmap.ALLOCATIONGRANULARITY
+MMAP_WINDOW = 64 * 1024 * 1024
+# The smallest byte range of a text trace read by one worker
+CANNED_SHARD_SIZE = 16 * 1024 * 1024
+DEFAULT_DATA_FILE = '.shellcov'
+# The fixed parts of a DEFAULT_PS4 record, as str and as bytes
+_PS4_TOKENS = {False: ('+', 'PS4', ' + ', 'L'),
+               True: (b'+', b'PS4', b' + ', b'L')}
 COLUMN_HEADINGS = ['Name', 'Stmts', 'Miss', 'Cover', 'Missing']
+SUMMARY_HEADINGS = COLUMN_HEADINGS[:4]
+# Exit status when coverage is below --fail-under
+FAIL_UNDER_EXIT = 2
+REPORT_FORMATS = ('text', 'json', 'cobertura', 'lcov')
+SCRIPT_SUFFIXES = ('.sh', '.bash', '.ksh')
+DEFAULT_TEST_PATTERNS = tuple(f'test_*{suffix}' for suffix in SCRIPT_SUFFIXES)
+# A directory listing is only cached once its mtime is this many nanoseconds
+# old, as a change within the same mtime tick would otherwise be missed
+_RACY_MTIME_NS = 2 * 10 ** 9
+# A unified diff hunk header, capturing the old length and new start and length
+RE_DIFF_HUNK = re.compile(r'@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+PROFILE_LINE_HEADINGS = ['Name', 'Line', 'Hits', 'Seconds']
+PROFILE_FUNCTION_HEADINGS = ['Name', 'Function', 'Hits', 'Seconds']
+# The positions of the bits set in each byte, for iterating over a LineSet
+_BYTE_BITS = tuple(tuple(bit for bit in range(8) if byte >> bit & 1)
+                   for byte in range(256))
+# int.bit_count is only available from Python 3.10
+_popcount = getattr(int, 'bit_count', lambda bits: bin(bits).count('1'))
 
 # All regex below assume that all lines in the search string have been trimmed
 RE_COMMENT = re.compile(r'''^#.*|(?<!["'\\{$])#.*''', MULTILINE)
@@ -36,7 +103,7 @@ RE_LINE_CONTINUATION = re.compile(r'''
 RE_HEREDOC = re.compile(r'''
     (               # Have one major group so findall gets what we want
     <<-?[ \t]*(')?  # <<-' (with or without the ', spaces, -)
-    ((?:[^'])+)     # the EOF type string
+    ([^'\n]+)       # the EOF type string, which can't span lines
     \2?$            # close EOF with ' if that exists
     .*?^\s*         # Contents
     \3              # Closing capture string
@@ -73,6 +140,22 @@ RE_FUNCTION = re.compile(r'''
     {?\s*\n                        # maybe a { with space and or newlines there
     ''', MULTILINE | VERBOSE)
 
+# Used by the single pass shell lexer
+_LEXER_KEYWORDS_OPEN = {'then', 'do', 'else', 'elif', 'if', 'while', 'until',
+                        '{', '!', 'time'}
+_LEXER_KEYWORDS_CLOSE = {'fi', 'done', '}'}
+_LEX_SPECIAL = frozenset(' \t\r\f\v\n;&|()<>\'"`\\$#[')
+_RE_LEX_PLAIN = re.compile(r'[^ \t\r\f\v\n;&|()<>\'"`\\$#\[]*')
+_RE_LEX_SPACE = re.compile(r'[ \t\r\f\v]+')
+_RE_LEX_OPERATOR = re.compile(r';;&|;;|;&|;|&&|&|\|\||\|&|\||\(|\)')
+_RE_LEX_ESCAPED_QUOTE = {q: re.compile(rf'{q}(?:[^{q}\\]|\\.)*{q}', DOTALL)
+                         for q in '"`'}
+_RE_LEX_TEST_START = re.compile(r'\[\[\s')
+_RE_LEX_TEST_END = re.compile(r'\]\](?=[\s;&|)]|$)', MULTILINE)
+# The tokens opening a function body, and the tokens closing them
+_FUNCTION_BODIES = {('word', '{'): ('word', '}'), ('op', '('): ('op', ')')}
+_RE_LEX_HEREDOC = re.compile(r'''<<-?[ \t]*(?:'([^'\n]*)'|"([^"\n]*)"|\\?([^\s;&|()<>]+))''')
+
 
 def parse_args(args: List[str]) -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -95,11 +178,113 @@ ShellCov Version = v{VERSION}
     parser.add_argument("--ignore-paths", nargs="+", help="Space separated list of paths to ignore. Any script which matches part of this will be ignored.", metavar='PATH')
     parser.add_argument("--replace-paths", nargs="+", help="Space separated list of colon separated paths. The left hand side is the original path prefix, the right hand side what to replace it with. This can be useful to work around bugs in BASH prior to 4.3alpha or when you are running the script on a different platform to where results are being analysed. E.g. --replace-paths /a/b/c/run:/home /a/b/c/d/run:/data", metavar='ORIG:REPLACE')
 
+    # Control how test scripts are run, and how many are run or analysed at once
+    parser.add_argument("--jobs", "-j", type=int, help="Number of test scripts to run, canned results to read, and scripts to analyse, at the same time. Defaults to the number of CPUs.", metavar='N')
+    parser.add_argument("--test-patterns", nargs="+", default=list(DEFAULT_TEST_PATTERNS), help="Space separated list of file name patterns (shell style) of the test scripts to find in --test-paths directories. Default: %(default)s", metavar='PATTERN')
+    parser.add_argument("--test-ignore", nargs="+", default=[], help="Space separated list of file or directory name patterns (shell style) to skip when finding test scripts, e.g. .git node_modules", metavar='PATTERN')
+    parser.add_argument("--test-index", help="Cache the test script search in this file, keyed by directory modification times, so unchanged directories are not listed again.", metavar='FILE')
+    parser.add_argument("--timeout", type=float, help="Kill any test script which is still running after this many seconds. Lines it executed before being killed are still counted.", metavar='SECONDS')
+    parser.add_argument("--runner", choices=RUNNERS, default='threads', help=f"How to run test scripts. 'asyncio' parses each trace as it arrives and prints each test's outcome and elapsed time as it finishes, and which tests are still running every {PROGRESS_INTERVAL} seconds. Default: %(default)s")
+    parser.add_argument("--fail-fast", action="store_true", help="With --runner asyncio, stop at the first test script which fails or times out, and exit with status 1 after reporting on the lines traced until then.")
+    parser.add_argument("--xtrace-fd", action="store_true", help="Run test scripts with bash (4.1+) and capture the trace through a dedicated pipe using BASH_XTRACEFD. The test scripts' stderr is then passed through rather than parsed.")
+
+    # How to analyse the scripts
+    parser.add_argument("--engine", choices=ENGINES, default='regex', help="How to find the executable lines in each script. 'regex' runs the original chain of regex passes, 'lexer' scans each script once tracking quotes, heredocs, comments, line continuations and functions, which understands more shell syntax. Default: %(default)s")
+    parser.add_argument("--cache-dir", help="Cache the executable lines of each script in this directory, keyed by a hash of the script contents, so unchanged scripts are not parsed again.", metavar='DIR')
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), help="Maximum size of --cache-dir in MiB. The least recently used entries are removed first. Default: %(default)s", metavar='MIB')
+
     # Choose multiple ways to analyse results
     group = parser.add_argument_group(title="Chose one of:")
     exclusive_group = group.add_mutually_exclusive_group(required=True)
-    exclusive_group.add_argument("--test-paths", "-t", nargs="+", help="Space separated list of directories to search in for test scripts, or, test scripts to run. Test script filenames must start with 'test_'", metavar='TEST_SCRIPT')
-    exclusive_group.add_argument("--canned-results", "-r", nargs="+", help="Space separated list of pre-generated outputs to analyse", metavar='RESULT')
+    exclusive_group.add_argument("--test-paths", "-t", nargs="+", help="Space separated list of directories to search in for test scripts, or, test scripts to run. Test script filenames must match --test-patterns, by default starting with 'test_'", metavar='TEST_SCRIPT')
+    exclusive_group.add_argument("--canned-results", "-r", nargs="+", help="Space separated list of pre-generated outputs to analyse. These can be raw -x traces or binary traces written by --record.", metavar='RESULT')
+
+    parser.add_argument("--contexts", action="store_true", help="Also record which test scripts executed each line, in --record and --data-file, for 'who-covers'. Needs --test-paths.")
+    parser.add_argument("--record", help="Also save the executed lines to this file in a compact binary format which --canned-results can read back much faster than a raw trace.", metavar='FILE')
+
+    # Accumulate coverage across runs
+    parser.add_argument("--data-file", help=f"Save the executed lines to this coverage data file (a binary trace), replacing its contents unless --append is given. Pass it to --canned-results to report on it, or merge data files with 'combine'. Default with --append: {DEFAULT_DATA_FILE}", metavar='FILE')
+    parser.add_argument("--append", action="store_true", help="Merge the executed lines into those already in --data-file, and report on the merged lines, rather than replacing them.")
+
+    # Only report on what a change touched
+    parser.add_argument("--diff", help="Only analyse and report the scripts, and lines, added or changed by this unified diff (e.g. from 'git diff'). Paths in it are relative to the current directory, after removing git's a/ and b/ prefixes.", metavar='DIFF_FILE')
+    parser.add_argument("--changed", nargs="+", help="Space separated list of changed scripts to analyse and report, in full. Can be combined with --diff.", metavar='PATH')
+    parser.add_argument("--select", action="store_true", help="Only run the test scripts affected by --diff and --changed, according to the test contexts in the data file from an earlier --contexts run. Tests which changed or are new run first, then those covering the most changed lines. Use with --contexts --append to keep the contexts up to date.")
+
+    # How to report the results
+    parser.add_argument("--format", choices=REPORT_FORMATS, default='text', help="Report format. 'json', 'cobertura' (XML) and 'lcov' are written out one script at a time for CI tools to read. Default: %(default)s")
+    parser.add_argument("--output", "-o", help="Write the report to this file rather than stdout.", metavar='FILE')
+    parser.add_argument("--summary-only", action="store_true", help="Only report the total coverage, as text or as json (the 'totals' of a json report). With --fail-under, scripts are only analysed until the outcome is certain.")
+    parser.add_argument("--fail-under", type=float, help=f"Exit with status {FAIL_UNDER_EXIT} if the total coverage is below this percentage.", metavar='PERCENT')
+
+    # Use the trace as a lightweight profiler
+    parser.add_argument("--profile", nargs="?", type=int, const=20, help="Also report the N (default %(const)s) lines and functions where the most time was spent, with how often each line ran. The time until the next trace record is charged to each line, read from the PS4 clock field. That is $EPOCHREALTIME with bash 5+, and whole $SECONDS otherwise. Only raw -x traces carry timing. The tables are printed to stderr.", metavar='N')
+    args = parser.parse_args(args)
+    if args.contexts and args.test_paths is None:
+        parser.error('--contexts needs --test-paths')
+    if args.fail_fast and args.runner != 'asyncio':
+        parser.error('--fail-fast needs --runner asyncio')
+    if args.summary_only and args.format not in ('text', 'json'):
+        parser.error(f'--summary-only only supports --format text or json, not {args.format}')
+    if args.select and (args.test_paths is None or (args.diff is None and args.changed is None)):
+        parser.error('--select needs --test-paths, and --diff or --changed')
+    return args
+
+
+def parse_combine_args(args: List[str]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='shell_cov combine',
+        description="Merge coverage data files, e.g. one written by each CI shard, into one data file.")
+    parser.add_argument("data_files", nargs="+", help="Data files (or other binary traces) to merge.", metavar='DATA_FILE')
+    parser.add_argument("--data-file", default=DEFAULT_DATA_FILE, help="The data file to write. Default: %(default)s", metavar='FILE')
+    parser.add_argument("--append", action="store_true", help="Merge into the lines already in --data-file rather than replacing them.")
+    return parser.parse_args(args)
+
+
+def parse_collect_args(args: List[str]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='shell_cov collect',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description="Collect coverage from long running shell processes as they run, and report on it on demand with 'shell_cov snapshot'.",
+        epilog=f"""
+Traced processes send their PS4 trace lines to the collector, e.g. with
+  exec 19>/path/to/fifo; BASH_XTRACEFD=19
+or
+  exec 19> >(nc -U /path/to/socket); BASH_XTRACEFD=19
+and PS4='{DEFAULT_PS4}'
+
+SIGUSR1 saves the lines collected so far to --data-file, as does SIGTERM or
+SIGINT before the collector exits.
+""")
+    parser.add_argument("--socket", help="Listen for traces, and snapshot requests, on this Unix socket.", metavar='PATH')
+    parser.add_argument("--fifo", help="Read traces from this FIFO, which is created if needed. Lines of up to PIPE_BUF bytes from concurrent writers do not interleave.", metavar='PATH')
+    parser.add_argument("--only-paths", "-p", nargs="+", help="As for the main command.", metavar='PATH')
+    parser.add_argument("--ignore-paths", nargs="+", help="As for the main command.", metavar='PATH')
+    parser.add_argument("--replace-paths", nargs="+", help="As for the main command.", metavar='ORIG:REPLACE')
+    parser.add_argument("--engine", choices=ENGINES, default='regex', help="How snapshots find the executable lines in each script. Default: %(default)s")
+    parser.add_argument("--cache-dir", help="As for the main command, for snapshots.", metavar='DIR')
+    parser.add_argument("--data-file", help="Save the collected lines to this coverage data file.", metavar='FILE')
+    parser.add_argument("--append", action="store_true", help="Start from the lines already in --data-file.")
+    args = parser.parse_args(args)
+    if args.socket is None and args.fifo is None:
+        parser.error('at least one of --socket or --fifo is required')
+    return args
+
+
+def parse_snapshot_args(args: List[str]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='shell_cov snapshot',
+        description="Print a coverage report of what a running 'shell_cov collect' has seen so far.")
+    parser.add_argument("--socket", required=True, help="The collector's Unix socket.", metavar='PATH')
+    parser.add_argument("--format", choices=REPORT_FORMATS, default='text', help="Report format. Default: %(default)s")
+    parser.add_argument("--output", "-o", help="Write the report to this file rather than stdout.", metavar='FILE')
+    return parser.parse_args(args)
+
+
+def parse_who_covers_args(args: List[str]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='shell_cov who-covers',
+        description="List the test scripts which executed each line, from a data file written with --contexts.")
+    parser.add_argument("locations", nargs="*", help="Scripts, or SCRIPT:LINE, to list. Default: every covered line.", metavar='SCRIPT[:LINE]')
+    parser.add_argument("--data-file", default=DEFAULT_DATA_FILE, help="The data file to read. Default: %(default)s", metavar='FILE')
+    parser.add_argument("--format", choices=('text', 'json'), default='text', help="'text' prints 'SCRIPT:LINE TEST...' per line, 'json' maps each script to {line: [tests]}. Default: %(default)s")
+    parser.add_argument("--tests-only", action="store_true", help="Only print each test which covers any of the lines once, e.g. to choose the tests to rerun when a script changes.")
     return parser.parse_args(args)
 
 
@@ -122,20 +307,40 @@ def get_range_string(items):
     return ', '.join(str_list)
 
 
+def _rewrite_matches(text, regex, replace, group=0):
+    '''Replace every match of regex in a single scan of text.
+
+    replace is called with the matched text (of the given group) and returns
+    its replacement, or None to leave it as is. The result is built from the
+    match offsets, so the cost is linear in the size of text.
+    '''
+    pieces = []
+    last = 0
+    for m in regex.finditer(text):
+        start, end = m.span(group)
+        replacement = replace(m.group(group))
+        if replacement is None:
+            continue
+        pieces.append(text[last:start])
+        pieces.append(replacement)
+        last = end
+    pieces.append(text[last:])
+    return ''.join(pieces)
+
+
 def shell_strip_line_continuation(text):
     # Line continuation marks the last line the executed line
     text = RE_LINE_CONTINUATION_REMOVE.sub('', text)
-    for match in RE_LINE_CONTINUATION.findall(text):
-        text = _replace_multiline_string_filler_at_end(text, match)
-    return text
+    return _rewrite_matches(text, RE_LINE_CONTINUATION,
+                            _multiline_string_filler_at_end)
 
 
-def _replace_multiline_string_filler_at_start(text, match):
-    return text.replace(match, FILLER + '\n' * match.count('\n'), 1)
+def _multiline_string_filler_at_start(match):
+    return FILLER + '\n' * match.count('\n')
 
 
-def _replace_multiline_string_filler_at_end(text, match):
-    return text.replace(match, '\n' * match.count('\n') + FILLER, 1)
+def _multiline_string_filler_at_end(match):
+    return '\n' * match.count('\n') + FILLER
 
 
 def shell_strip_escaped_quotes(text):
@@ -151,32 +356,469 @@ def shell_strip_xtrace(text):
 
 
 def shell_strip_heredoc(text):
-    d = [g[0] for g in RE_HEREDOC.findall(text)]
-    for match in d:
-        text = _replace_multiline_string_filler_at_start(text, match)
-    return text
+    # Group 1 has specifically been designed to be the full match
+    return _rewrite_matches(text, RE_HEREDOC,
+                            _multiline_string_filler_at_start, 1)
 
 
 def shell_strip_function(text):
-    for match in RE_FUNCTION.findall(text):
-        text = text.replace(match, '\n' * match.count('\n'), 1)
-    return text
+    return _rewrite_matches(text, RE_FUNCTION,
+                            lambda match: '\n' * match.count('\n'))
 
 
 def shell_strip_multiline_quotes(text):
-    # The last line is classified as the line that was executed
-    # As findall returns the matching group, take the first group which
+    # The last line is classified as the line that was executed. Group 1
     # has specifically been designed to be the full match.
-    for match in [g[0] for g in RE_MULTI_LINE_QUOTE.findall(text)]:
-        if '\n' in match:
-            text = text.replace(match, '\n' * match.count('\n') + FILLER, 1)
-    return text
+    return _rewrite_matches(
+        text, RE_MULTI_LINE_QUOTE,
+        lambda match: _multiline_string_filler_at_end(match)
+        if '\n' in match else None, 1)
 
 
 def shell_strip_logic(text):
     return RE_LOGIC_OPERATOR.sub('', text)
 
 
+def _skip_quoted(text, pos, quote):
+    # Return the position just after the quote closing the one at pos,
+    # honouring backslash escapes unless it is a single quote
+    if quote == "'":
+        end = text.find("'", pos + 1)
+        return len(text) if end == -1 else end + 1
+    m = _RE_LEX_ESCAPED_QUOTE[quote].match(text, pos)
+    return m.end() if m else len(text)
+
+
+def _skip_nested(text, pos, opener, closer):
+    # Return the position just after the closer matching the opener at pos.
+    # Quotes inside are skipped. If it is never closed, stop at the end of
+    # the line so one unbalanced bracket can't swallow the rest of the script
+    depth = 0
+    i = pos
+    while i < len(text):
+        if text.startswith(opener, i):
+            depth += 1
+            i += len(opener)
+        elif text.startswith(closer, i):
+            depth -= 1
+            i += len(closer)
+            if depth == 0:
+                return i
+        elif text[i] in '\'"`':
+            i = _skip_quoted(text, i, text[i])
+        elif text[i] == '\\':
+            i += 2
+        else:
+            i += 1
+    end = text.find('\n', pos)
+    return len(text) if end == -1 else end
+
+
+def _lex_shell(text):
+    '''Split shell text into (kind, value, line) tokens in a single scan.
+
+    kind is one of 'word', 'op', 'newline', 'push' or 'pop'. Quoted strings,
+    ${...}, $((...)), ((...)), [[...]] and array assignments are kept whole
+    inside words, even when they span lines. Comments, line continuations
+    and heredoc bodies produce no tokens. 'push' and 'pop' surround the
+    commands inside $(...), <(...) and >(...), which are lexed normally so
+    multi-line command substitutions keep their own lines.
+    '''
+    pos = 0
+    line = 1
+    length = len(text)
+    word = []
+    in_word = False
+    parens = []
+    heredocs = []
+    while pos < length:
+        c = text[pos]
+        start = pos
+        if c not in _LEX_SPECIAL:
+            pos = _RE_LEX_PLAIN.match(text, pos).end()
+            word.append(text[start:pos])
+            in_word = True
+            continue
+        if c == '\n':
+            if word:
+                yield 'word', ''.join(word), line
+            word, in_word = [], False
+            yield 'newline', c, line
+            pos += 1
+            line += 1
+            # Heredoc bodies start on the line after the redirection
+            for delimiter in heredocs:
+                while pos < length:
+                    end = text.find('\n', pos)
+                    end = length if end == -1 else end
+                    body_line = text[pos:end]
+                    pos = end + 1
+                    line += 1
+                    if body_line.strip() == delimiter:
+                        break
+            heredocs = []
+            continue
+        if c in ' \t\r\f\v':
+            if word:
+                yield 'word', ''.join(word), line
+            word, in_word = [], False
+            pos = _RE_LEX_SPACE.match(text, pos).end()
+            continue
+        if c == '\\':
+            if text.startswith('\n', pos + 1):
+                # Line continuation joins the lines without ending the word
+                line += 1
+            else:
+                word.append(text[pos:pos + 2])
+                in_word = True
+            pos += 2
+            continue
+        if c == '#' and not in_word:
+            end = text.find('\n', pos)
+            pos = length if end == -1 else end
+            continue
+
+        if c in '\'"`':
+            pos = _skip_quoted(text, pos, c)
+        elif c == '$' and text.startswith(("$'", '$"'), pos):
+            pos = _skip_quoted(text, pos + 1, text[pos + 1])
+        elif text.startswith('$((', pos):
+            pos = _skip_nested(text, pos + 1, '(', ')')
+        elif text.startswith('${', pos):
+            pos = _skip_nested(text, pos + 1, '{', '}')
+        elif text.startswith(('$(', '<(', '>('), pos):
+            # The word so far belongs to the outer command
+            word.append(text[pos])
+            yield 'word', ''.join(word), line
+            word, in_word = [], True
+            yield 'push', text[pos:pos + 2], line
+            parens.append('push')
+            pos += 2
+            continue
+        elif not in_word and text.startswith('((', pos):
+            pos = _skip_nested(text, pos, '(', ')')
+        elif not in_word and _RE_LEX_TEST_START.match(text, pos):
+            m = _RE_LEX_TEST_END.search(text, pos)
+            pos = m.end() if m else _skip_nested(text, pos, '[[', ']]')
+        elif c == '(' and word and word[-1].endswith('='):
+            # Array assignment
+            pos = _skip_nested(text, pos, '(', ')')
+        elif text.startswith('<<', pos) and not text.startswith('<<<', pos):
+            m = _RE_LEX_HEREDOC.match(text, pos)
+            if m:
+                heredocs.append(next(g for g in m.groups() if g is not None))
+                pos = m.end()
+            else:
+                pos += 2
+        elif c == '&' and (text.startswith('&>', pos)
+                           or (word and word[-1][-1:] in ('<', '>'))):
+            # &>file, >&2 and <&0 are redirections, not operators
+            pos += 1
+        elif c in ';&|()':
+            if word:
+                yield 'word', ''.join(word), line
+            word, in_word = [], False
+            if c == ')' and parens and parens.pop() == 'push':
+                yield 'pop', c, line
+                in_word = True
+                pos += 1
+                continue
+            if c == '(':
+                parens.append('(')
+            m = _RE_LEX_OPERATOR.match(text, pos)
+            yield 'op', m.group(), line
+            pos = m.end()
+            continue
+        else:
+            pos = max(_RE_LEX_PLAIN.match(text, pos).end(), pos + 1)
+
+        chunk = text[start:pos]
+        line += chunk.count('\n')
+        word.append(chunk)
+        in_word = True
+    if word:
+        yield 'word', ''.join(word), line
+    yield 'newline', '', line
+
+
+def shell_lexer_lines(text):
+    '''Return the executable line numbers of text using the shell lexer.
+
+    This is a single pass alternative to the regex strip pipeline. It
+    tracks quotes, heredocs, comments, line continuation, function
+    definitions and compound command keywords as it goes, following the same
+    conventions as the regex pipeline: a command spanning lines counts on
+    its last line, except heredocs which count on the line of the
+    redirection. Commands inside a multi-line $(...) count on their own
+    lines.
+    '''
+    lines = set()
+    # One level per nested command substitution
+    levels = [_LexerLevel()]
+    tokens = list(_lex_shell(text))
+    i = 0
+    while i < len(tokens):
+        kind, value, line = tokens[i]
+        level = levels[-1]
+        i += 1
+        if kind == 'newline':
+            level.end_command()
+            if level.executable:
+                lines.add(line)
+                level.executable = False
+            if level.mode not in ('case_header', 'pattern'):
+                level.mode = 'start'
+        elif kind == 'push':
+            level.word(None)
+            levels.append(_LexerLevel())
+        elif kind == 'pop':
+            if len(levels) > 1:
+                level.end_command()
+                levels.pop()
+                levels[-1].executable |= level.executable
+        elif kind == 'op':
+            if level.mode == 'pattern':
+                if value == ')':
+                    level.mode = 'start'
+                continue
+            if level.mode == 'function' and value in '()':
+                if value == ')':
+                    level.mode = 'start'
+                continue
+            level.end_command()
+            if value in (';;', ';&', ';;&') and level.cases:
+                level.mode = 'pattern'
+            elif value == ')':
+                level.mode = 'closed'
+            else:
+                level.mode = 'start'
+        elif (level.mode == 'start' and i + 1 < len(tokens)
+              and tokens[i][:2] == ('op', '(')
+              and tokens[i + 1][:2] == ('op', ')')):
+            # name() function definition
+            i += 2
+        else:
+            level.word(value)
+    return lines
+
+
+def shell_function_spans(text):
+    '''Return (name, first_line, last_line) for each function defined in text.
+
+    Both 'name() body' and 'function name body' forms are found, with brace
+    or subshell bodies, using the shell lexer so braces and parentheses in
+    quotes, heredocs and comments are ignored. Spans are in order of where
+    the functions end, so nested functions come before the outer function.
+    '''
+    spans = []
+    # [name, first line, opener, closer, depth] for each unclosed body
+    bodies = []
+    # Where in a function header the previous tokens were
+    header = None
+    name = first = None
+    at_start = True
+    for kind, value, line in _lex_shell(text):
+        token = (kind, value)
+        for body in bodies:
+            if token == body[2]:
+                body[4] += 1
+            elif token == body[3]:
+                body[4] -= 1
+        while bodies and bodies[-1][4] == 0:
+            body = bodies.pop()
+            spans.append((body[0], body[1], line))
+
+        if header == 'optional_parens' and token != ('op', '('):
+            header = 'body'
+        if header == 'body':
+            if kind == 'newline':
+                continue
+            header = None
+            if token in _FUNCTION_BODIES:
+                bodies.append([name, first, token, _FUNCTION_BODIES[token], 1])
+                at_start = True
+                continue
+        elif header == 'name' and kind == 'word':
+            name, header = value, 'optional_parens'
+            continue
+        elif header in ('parens', 'optional_parens') and token == ('op', '('):
+            header = 'close_paren'
+            continue
+        elif header == 'close_paren' and token == ('op', ')'):
+            header = 'body'
+            continue
+        else:
+            header = None
+
+        if kind == 'word':
+            if at_start and value == 'function':
+                header, first = 'name', line
+            elif at_start:
+                header, name, first = 'parens', value, line
+            at_start = value in _LEXER_KEYWORDS_OPEN
+        else:
+            at_start = True
+    return spans
+
+
+class _LexerLevel:
+    # Parser state for the commands at one level of command substitution
+
+    def __init__(self):
+        self.mode = 'start'
+        self.executable = False
+        self.cases = 0
+        self.set_words = []
+
+    def end_command(self):
+        if self.mode == 'set':
+            if not RE_SET_XTRACE.match(' '.join(self.set_words)):
+                self.executable = True
+            self.mode = 'args'
+
+    def word(self, value):
+        mode = self.mode
+        if mode == 'set':
+            self.set_words.append(value or '')
+        elif mode == 'function':
+            if value in ('{', None):
+                self.mode = 'start'
+        elif mode == 'case_header':
+            if value == 'in':
+                self.cases += 1
+                self.mode = 'pattern'
+        elif mode == 'pattern':
+            if value == 'esac':
+                self.cases -= 1
+                self.mode = 'closed'
+        elif mode == 'start':
+            if value == 'esac' and self.cases:
+                self.cases -= 1
+                self.mode = 'closed'
+            elif value in _LEXER_KEYWORDS_OPEN:
+                pass
+            elif value in _LEXER_KEYWORDS_CLOSE:
+                self.mode = 'closed'
+            elif value == 'function':
+                self.mode = 'function'
+            elif value == 'set':
+                self.mode = 'set'
+                self.set_words = ['set']
+            else:
+                self.executable = True
+                self.mode = 'case_header' if value == 'case' else 'args'
+
+
+class LineSet:
+    '''A set of line numbers stored as the bits of a single int.
+
+    Bit n is set when line n is in the set, so a script's lines take about a
+    bit each rather than an int object and a hash table slot each. Union,
+    intersection and difference are single bitwise operations on the whole
+    set and the size is a popcount. Iterating yields the line numbers in
+    ascending order.
+
+    It supports the parts of the set API used here, accepts any iterable of
+    line numbers (including plain sets) wherever it accepts another LineSet,
+    and compares equal to a set of the same numbers.
+    '''
+    __slots__ = ('_bits',)
+    __hash__ = None
+
+    def __init__(self, lines=()):
+        self._bits = _line_bits(lines)
+
+    @classmethod
+    def _from_bits(cls, bits):
+        line_set = cls.__new__(cls)
+        line_set._bits = bits
+        return line_set
+
+    def add(self, line):
+        self._bits |= 1 << line
+
+    def discard(self, line):
+        self._bits &= ~(1 << line)
+
+    def update(self, *others):
+        for other in others:
+            self._bits |= _line_bits(other)
+
+    def difference_update(self, *others):
+        for other in others:
+            self._bits &= ~_line_bits(other)
+
+    def copy(self):
+        return self._from_bits(self._bits)
+
+    def union(self, *others):
+        bits = self._bits
+        for other in others:
+            bits |= _line_bits(other)
+        return self._from_bits(bits)
+
+    def intersection(self, other):
+        return self._from_bits(self._bits & _line_bits(other))
+
+    def difference(self, other):
+        return self._from_bits(self._bits & ~_line_bits(other))
+
+    def issubset(self, other):
+        return not self._bits & ~_line_bits(other)
+
+    __or__ = __ror__ = union
+    __and__ = __rand__ = intersection
+    __sub__ = difference
+    __le__ = issubset
+
+    def __rsub__(self, other):
+        return self._from_bits(_line_bits(other) & ~self._bits)
+
+    def __contains__(self, line):
+        return isinstance(line, int) and line >= 0 and bool(self._bits >> line & 1)
+
+    def __iter__(self):
+        data = self._bits.to_bytes((self._bits.bit_length() + 7) // 8, 'little')
+        for index, byte in enumerate(data):
+            if byte:
+                base = index * 8
+                for bit in _BYTE_BITS[byte]:
+                    yield base + bit
+
+    def __len__(self):
+        return _popcount(self._bits)
+
+    def __bool__(self):
+        return bool(self._bits)
+
+    def __eq__(self, other):
+        if isinstance(other, LineSet):
+            return self._bits == other._bits
+        if isinstance(other, (set, frozenset)):
+            return len(other) == len(self) and all(n in self for n in other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f'LineSet({set(self)!r})' if self else 'LineSet()'
+
+
+def _line_bits(lines):
+    # The LineSet bits for any iterable of line numbers
+    if isinstance(lines, LineSet):
+        return lines._bits
+    if not isinstance(lines, (set, frozenset, list, tuple, array, range)):
+        lines = list(lines)
+    if not lines:
+        return 0
+    if min(lines) < 0:
+        raise ValueError('line numbers cannot be negative')
+    # Setting bits in a bytearray is far cheaper than growing an int per line
+    bitmap = bytearray(max(lines) // 8 + 1)
+    for line in lines:
+        bitmap[line >> 3] |= 1 << (line & 7)
+    return int.from_bytes(bitmap, 'little')
+
+
 def determine_display_widths(values):
     # Figure out the widths
     widths = [max(map(len, col)) for col in zip(*values)]
@@ -185,194 +827,2032 @@ def determine_display_widths(values):
     return widths, header_widths
 
 
+def iter_coverage(actual_lines, seen_lines):
+    '''Yield (script, need, covered, not_covered, unrecognised) per script.
+
+    need is the set of executable lines in the script, split into covered
+    and not_covered, and unrecognised is the executed lines which are not
+    executable. Each script is computed as it is reached, so reports can be
+    written out one script at a time. actual_lines is a dict or, to analyse
+    scripts only as the report reaches them, an iterable of (script, lines)
+    pairs such as iter_lines_in_scripts yields.
+    '''
+    if isinstance(actual_lines, dict):
+        actual_lines = actual_lines.items()
+    for script, need in actual_lines:
+        seen = LineSet(seen_lines[script])
+        need = LineSet(need)
+        yield (script, need, need.intersection(seen), need.difference(seen),
+               seen.difference(need))
+
+
 def get_line_info(actual_lines, seen_lines):
     column_values = [COLUMN_HEADINGS]
     problem_lines = {}
-    for script in actual_lines:
-        covered = seen_lines[script]
-        need = actual_lines[script]
-        unrecognised_lines = covered.difference(need)
-        not_covered = need.difference(covered)
+    for script, need, _, not_covered, unrecognised_lines in iter_coverage(
+            actual_lines, seen_lines):
         column_values.append([script, str(len(need)), str(len(not_covered)),
-                              str(100 * (len(need)
-                                  - len(not_covered)) // len(need))
-                              + '%',
+                              str(int(_percent(len(need) - len(not_covered),
+                                               len(need)))) + '%',
                               get_range_string(sorted(not_covered))])
         problem_lines[script] = unrecognised_lines
     return column_values, problem_lines
 
 
-def display_results(actual_lines, seen_lines):
+def display_results(actual_lines, seen_lines, f=None):
     # Get the test coverage information
     column_values, problem_lines = get_line_info(actual_lines, seen_lines)
 
     # Calculate widths and values for each column
     widths, header_widths = determine_display_widths(column_values)
 
-    # Print the results
-    print('---- coverage ----')
+    # Print the results, to f if given rather than stdout
+    print('---- coverage ----', file=f)
     print('  '.join(val.ljust(width) for val, width in zip(column_values[0],
-                                                           header_widths)))
+                                                           header_widths)),
+          file=f)
     for row in column_values[1:]:
-        print('  '.join(val.ljust(width) for val, width in zip(row, widths)))
+        print('  '.join(val.ljust(width) for val, width in zip(row, widths)),
+              file=f)
         # Warn about any problem lines as these should be fixed in this script
         if problem_lines[row[0]]:
             print('**** lines reached that are not understood: ' +
-                  get_range_string(sorted(problem_lines[row[0]])))
+                  get_range_string(sorted(problem_lines[row[0]])), file=f)
 
 
-def get_test_results(test_scripts):
+def summarise_coverage(actual_lines, seen_lines, fail_under: float =None):
+    '''Return (statements, covered, scripts read, passed) totals.
+
+    actual_lines is as for iter_coverage. passed is whether the total
+    coverage is at least fail_under percent, or None if it isn't given.
+
+    With fail_under, actual_lines is only read until the outcome is certain,
+    so the remaining scripts are never analysed and the totals only cover
+    the scripts read. A script not yet read can add at most the lines it
+    executed to both totals, and at most its length in lines to statements.
+    '''
+    statements = covered_lines = read = 0
+    if fail_under is not None:
+        # The most covered lines, and statements, the unread scripts can add
+        seen_left = sum(len(lines) for lines in seen_lines.values())
+        lengths = {script: _count_lines(script) for script in seen_lines}
+        length_left = sum(lengths.values())
+    for script, need, covered, _, _ in iter_coverage(actual_lines,
+                                                     seen_lines):
+        statements += len(need)
+        covered_lines += len(covered)
+        read += 1
+        if fail_under is None:
+            continue
+        seen_left -= len(seen_lines[script])
+        length_left -= lengths[script]
+        if _percent(covered_lines + seen_left,
+                    statements + seen_left) < fail_under:
+            return statements, covered_lines, read, False
+        if _percent(covered_lines, statements + length_left) >= fail_under:
+            return statements, covered_lines, read, True
+    passed = None
+    if fail_under is not None:
+        passed = _percent(covered_lines, statements) >= fail_under
+    return statements, covered_lines, read, passed
+
+
+def _count_lines(script):
+    try:
+        with open(script, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return 0
+    return data.count(b'\n') + (not data.endswith(b'\n'))
+
+
+def display_summary(statements, covered_lines, read, total, f=None):
+    print('---- coverage ----', file=f)
+    values = [SUMMARY_HEADINGS,
+              ['TOTAL', str(statements), str(statements - covered_lines),
+               f'{int(_percent(covered_lines, statements))}%']]
+    widths = [max(map(len, col)) for col in zip(*values)]
+    for row in values:
+        print('  '.join(val.ljust(width) for val, width in zip(row, widths)),
+              file=f)
+    if read < total:
+        print(f'**** stopped after {read} of {total} scripts, as the rest '
+              'cannot change the --fail-under outcome', file=f)
+
+
+def write_json_report(coverage, f):
+    '''Write the iter_coverage records in coverage to f as JSON.
+
+    Each script is written as soon as it is read from coverage, and the
+    totals come last, so the report is never held in memory.
+    '''
+    f.write('{"meta": %s, "files": {' % json.dumps(
+        {'version': VERSION, 'timestamp': int(time.time())}))
+    statements = covered_lines = 0
+    for index, (script, need, covered, not_covered,
+                unrecognised) in enumerate(coverage):
+        statements += len(need)
+        covered_lines += len(covered)
+        f.write('%s\n%s: %s' % (',' if index else '', json.dumps(script),
+                                json.dumps({
+            'executed_lines': list(covered),
+            'missing_lines': list(not_covered),
+            'unrecognised_lines': list(unrecognised),
+            'summary': _json_summary(len(need), len(covered)),
+        })))
+    f.write('\n}, "totals": %s}\n' % json.dumps(
+        _json_summary(statements, covered_lines)))
+
+
+def write_json_summary(statements, covered_lines, read, total, f):
+    '''Write the display_summary totals to f as JSON, like a json report's.'''
+    json.dump({'meta': {'version': VERSION, 'timestamp': int(time.time())},
+               'totals': _json_summary(statements, covered_lines),
+               'scripts_read': read, 'scripts': total}, f)
+    f.write('\n')
+
+
+def _json_summary(statements, covered_lines):
+    return {'num_statements': statements, 'covered_lines': covered_lines,
+            'missing_lines': statements - covered_lines,
+            'percent_covered': _percent(covered_lines, statements)}
+
+
+def _percent(covered_lines, statements):
+    # A script with nothing to run is fully covered
+    return 100 * covered_lines / statements if statements else 100.0
+
+
+def write_cobertura_report(coverage, f):
+    '''Write the iter_coverage records in coverage to f as Cobertura XML.
+
+    The totals are attributes of the root element, so each script's class
+    element is spooled to a temporary file (on disk once it grows past a few
+    MiB) as it is read from coverage, and copied to f after the root.
+    '''
+    statements = covered_lines = 0
+    with tempfile.SpooledTemporaryFile(4 * 1024 * 1024, mode='w+') as classes:
+        for script, need, covered, _, _ in coverage:
+            statements += len(need)
+            covered_lines += len(covered)
+            classes.write(
+                f'\t\t\t\t<class name={quoteattr(os.path.basename(script))} '
+                f'filename={quoteattr(script)} '
+                f'line-rate="{_rate(len(covered), len(need))}" '
+                'branch-rate="0" complexity="0">\n'
+                '\t\t\t\t\t<methods/>\n\t\t\t\t\t<lines>\n')
+            classes.writelines(
+                f'\t\t\t\t\t\t<line number="{line}" '
+                f'hits="{int(line in covered)}"/>\n' for line in need)
+            classes.write('\t\t\t\t\t</lines>\n\t\t\t\t</class>\n')
+
+        rate = _rate(covered_lines, statements)
+        f.write('<?xml version="1.0" ?>\n'
+                '<!DOCTYPE coverage SYSTEM "http://cobertura.sourceforge.net'
+                '/xml/coverage-04.dtd">\n'
+                f'<coverage version="{VERSION}" '
+                f'timestamp="{int(time.time() * 1000)}" '
+                f'lines-valid="{statements}" lines-covered="{covered_lines}" '
+                f'line-rate="{rate}" branches-covered="0" branches-valid="0" '
+                'branch-rate="0" complexity="0">\n'
+                '\t<packages>\n'
+                f'\t\t<package name="." line-rate="{rate}" branch-rate="0" '
+                'complexity="0">\n\t\t\t<classes>\n')
+        classes.seek(0)
+        shutil.copyfileobj(classes, f)
+        f.write('\t\t\t</classes>\n\t\t</package>\n\t</packages>\n'
+                '</coverage>\n')
+
+
+def _rate(covered_lines, statements):
+    return f'{_percent(covered_lines, statements) / 100:.4g}'
+
+
+def write_lcov_report(coverage, f):
+    '''Write the iter_coverage records in coverage to f as an LCOV tracefile.
+
+    Each script is a self-contained record, written as soon as it is read.
+    '''
+    for script, need, covered, _, _ in coverage:
+        f.write(f'TN:\nSF:{script}\n')
+        f.writelines(f'DA:{line},{int(line in covered)}\n' for line in need)
+        f.write(f'LF:{len(need)}\nLH:{len(covered)}\nend_of_record\n')
+
+
+REPORT_WRITERS = {'json': write_json_report,
+                  'cobertura': write_cobertura_report,
+                  'lcov': write_lcov_report}
+
+
+def write_report(report_format, lines_to_cover, script_lines, f):
+    '''Write a report in one of REPORT_FORMATS to the text file f.'''
+    if report_format == 'text':
+        display_results(lines_to_cover, script_lines, f)
+    else:
+        REPORT_WRITERS[report_format](
+            iter_coverage(lines_to_cover, script_lines), f)
+
+
+def get_profile_info(profile, limit: int =20):
+    '''Return display rows for the hottest lines and functions in profile.
+
+    Lines and functions are ordered by the time spent in them, then by how
+    many times their lines ran. Each line is charged to the innermost
+    function defined around it, see shell_function_spans.
+    '''
+    line_rows = []
+    functions = {}
+    for script, lines in profile.items():
+        spans = _get_function_spans(script)
+        for line_number, (hits, seconds) in lines.items():
+            line_rows.append((seconds, hits, script, line_number))
+            # Nested functions come first, so the first match is innermost
+            for name, first, last in spans:
+                if first <= line_number <= last:
+                    counts = functions.setdefault((script, name, first),
+                                                  [0, 0.0])
+                    counts[0] += hits
+                    counts[1] += seconds
+                    break
+    line_rows.sort(key=lambda row: (-row[0], -row[1], row[2], row[3]))
+    function_rows = sorted(((seconds, hits) + key
+                            for key, (hits, seconds) in functions.items()),
+                           key=lambda row: (-row[0], -row[1], row[2:]))
+
+    line_values = [PROFILE_LINE_HEADINGS]
+    for seconds, hits, script, line_number in line_rows[:limit]:
+        line_values.append([script, str(line_number), str(hits),
+                            f'{seconds:.6f}'])
+    function_values = [PROFILE_FUNCTION_HEADINGS]
+    for seconds, hits, script, name, first in function_rows[:limit]:
+        function_values.append([script, f'{name} (L{first})', str(hits),
+                                f'{seconds:.6f}'])
+    return line_values, function_values
+
+
+def _get_function_spans(script):
+    try:
+        with open(script, encoding='utf-8', errors='replace') as f:
+            return shell_function_spans(f.read())
+    except OSError:
+        return []
+
+
+def display_profile(profile, limit: int =20, f=None):
+    titles = ('---- hottest lines ----', '---- hottest functions ----')
+    for title, values in zip(titles, get_profile_info(profile, limit)):
+        widths = [max(map(len, col)) for col in zip(*values)]
+        print(title, file=f)
+        for row in values:
+            print('  '.join(val.ljust(width) for val, width in zip(row, widths)),
+                  file=f)
+
+
+def iter_ps4_records(lines):
+    '''Yield (script, duration, line_number) for each PS4 line in lines.
+
+    lines may be str or, to skip decoding every line, raw bytes. Lines not
+    starting with '+' are rejected after a one character comparison, and
+    records are split into the DEFAULT_PS4 fields in a single call. Only the
+    script path is decoded, once per distinct path, and interned so a path
+    repeated through a trace is one string object. The duration is left as
+    str or bytes, matching the lines.
+
+    Lines which were not generated by DEFAULT_PS4 are skipped, as are records
+    with a line number of 0 as that is not a real line number.
+
+    Measured with the get_executed_lines benchmark in test/benchmark.py on
+    CPython 3.11, a trace file is ingested at roughly 550-650 thousand lines
+    per second (about 35 MB/s), up from about 440 thousand when every line
+    was decoded and split as a str.
+    '''
+    lines = iter(lines)
+    first = next(lines, None)
+    if first is None:
+        return
+    binary = isinstance(first, bytes)
+    plus, ps4, separator, line_prefix = _PS4_TOKENS[binary]
+    scripts = {}
+    for line in chain((first,), lines):
+        # Cheapest possible rejection of lines which are not trace records
+        if line[:1] != plus:
+            continue
+        fields = line.lstrip(plus).split(separator, 4)
+        if len(fields) < 5 or fields[0] != ps4:
+            continue
+        _, script, duration, line_number, _ = fields
+        if line_number[:1] != line_prefix:
+            continue
+        try:
+            line_number = int(line_number[1:])
+        except ValueError:
+            # Shells without LINENO
+            continue
+        if line_number == 0:
+            continue
+        decoded = scripts.get(script)
+        if decoded is None:
+            decoded = scripts[script] = (
+                script.decode('utf-8', errors='replace') if binary
+                else sys.intern(script))
+        yield decoded, duration, line_number
+
+
+def _iter_file_lines(path, window: int =MMAP_WINDOW, start: int =0, stop: int =None):
+    '''Yield the lines of the trace file at path which may be PS4 records.
+
+    Regular files are memory-mapped window bytes at a time and read in place,
+    so at most one window is mapped at once and each is unmapped as soon as
+    its lines have been read. A line straddling two windows is joined up.
+    Other files (e.g. pipes) are read line by line.
+
+    Only the lines starting in the byte range [start, stop) are yielded, so
+    consecutive ranges of a regular file yield each line exactly once.
+
+    This is a generator, so the file is only opened once parsing reaches it.
+    '''
+    with open(path, 'rb') as f:
+        info = os.fstat(f.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            yield from f
+            return
+
+        start = _next_line_start(f, start)
+        stop = _next_line_start(f, info.st_size if stop is None
+                                else min(stop, info.st_size))
+        # Any partial line at the end of the previous window
+        tail = b''
+        first = start - start % mmap.ALLOCATIONGRANULARITY
+        for offset in range(first, stop, window):
+            length = min(window, stop - offset)
+            with mmap.mmap(f.fileno(), length, offset=offset,
+                           access=mmap.ACCESS_READ) as mapped:
+                if hasattr(mapped, 'madvise'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                mapped.seek(max(start - offset, 0))
+                line = tail + mapped.readline()
+                while line.endswith(b'\n'):
+                    yield line
+                    line = mapped.readline()
+                tail = line
+        if tail:
+            yield tail
+
+
+def _next_line_start(f, position):
+    # The offset of the first line in f starting at or after position
+    if position <= 0:
+        return 0
+    f.seek(position - 1)
+    f.readline()
+    return f.tell()
+
+
+def _drain_stream(stream, tail):
+    # Keep the pipe empty so the child can never block writing to it
+    with stream:
+        for line in stream:
+            tail.append(line)
+
+
+def _kill_process_group(proc, killed):
+    killed.set()
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _iter_process_lines(proc, trace, script, stdout_drain, stdout_tail,
+                        timeout=None):
+    '''Stream the trace of a running test while stdout is drained in a thread.
+
+    Trace lines are yielded as they arrive so they can be parsed straight
+    away. If timeout seconds pass before the test finishes, the test (and any
+    processes it started) is killed, a warning including the end of its
+    stdout is printed and the lines traced so far are kept.
+    '''
+    timer = None
+    timed_out = threading.Event()
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_process_group,
+                                (proc, timed_out))
+        timer.daemon = True
+        timer.start()
+    try:
+        yield from trace
+    finally:
+        trace.close()
+        proc.wait()
+        stdout_drain.join()
+        if timer is not None:
+            timer.cancel()
+        if timed_out.is_set():
+            _warn_timed_out(script, timeout, stdout_tail)
+
+
+def _warn_timed_out(script, timeout, stdout_tail):
+    print(f'**** {script} timed out after {timeout}s, last output:',
+          file=sys.stderr)
+    for line in stdout_tail:
+        print('    ' + line.decode('utf-8', errors='replace').rstrip(),
+              file=sys.stderr)
+
+
+def _get_test_env():
+    use_env = os.environ.copy()
+    use_env['PS4'] = DEFAULT_PS4
+    return use_env
+
+
+def _run_test_script(script, env, timeout=None, xtrace_fd=False):
+    '''Start a test script, returning its (stdout, trace lines) result.
+
+    By default the trace is read from the test's stderr. With xtrace_fd, the
+    test is run by bash with BASH_XTRACEFD pointing at a dedicated pipe, so
+    only trace records are parsed and the test's own stderr is passed
+    through untouched.
+    '''
+    if not os.path.isfile(script):
+        raise OSError('"{}" does not exist, aborting!'.format(script))
+    if xtrace_fd:
+        read_fd, write_fd = os.pipe()
+        env = dict(env, BASH_XTRACEFD=str(write_fd))
+        popen_kwargs = {'args': BASH_CMD + [script], 'stderr': None,
+                        'pass_fds': (write_fd,)}
+    else:
+        popen_kwargs = {'args': BASE_CMD + [script], 'stderr': subprocess.PIPE}
+    # Start a new session so a timeout can kill everything the test started,
+    # otherwise an orphaned child could hold the trace pipe open forever
+    try:
+        proc = subprocess.Popen(env=env, stdout=subprocess.PIPE,  # nosec
+                                start_new_session=True, **popen_kwargs)
+    finally:
+        if xtrace_fd:
+            # Only the child should hold the write end, so the trace ends
+            # when the test does
+            os.close(write_fd)
+    trace = os.fdopen(read_fd, 'rb') if xtrace_fd else proc.stderr
+    stdout_tail = deque(maxlen=STDOUT_TAIL_LINES)
+    stdout_drain = threading.Thread(target=_drain_stream,
+                                    args=(proc.stdout, stdout_tail),
+                                    daemon=True)
+    stdout_drain.start()
+    # TODO: Strip out the test script from the output
+    return ('', _iter_process_lines(proc, trace, script, stdout_drain,
+                                    stdout_tail, timeout))
+
+
+def get_test_results(test_scripts, timeout: float =None, xtrace_fd: bool =False):
     # If stdin is not provided, assume a file is provided
     if sys.stdin.isatty():
-        test_results = []
-        use_env = os.environ.copy()
-        use_env['PS4'] = DEFAULT_PS4
-
+        use_env = _get_test_env()
         for s in test_scripts:
-            if not os.path.isfile(s):
-                raise OSError('"{}" does not exist, aborting!'.format(s))
-            proc = subprocess.Popen(BASE_CMD + [s],  # nosec
-                                    env=use_env, stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-            proc.wait()
-            # TODO: Strip out the test script from the output
-            test_results.append(tuple(map(lambda x: x.decode('utf-8'),
-                                          proc.communicate())))
+            yield _run_test_script(s, use_env, timeout, xtrace_fd)
     else:
-        test_results = [('', '\n'.join([l for l in sys.stdin]))]
-    return test_results
+        yield ('', getattr(sys.stdin, 'buffer', sys.stdin))
 
 
-def get_executed_lines(test_results, path_include: List[str] =None, path_ignore:List[str]=None,path_replace: List[str] =None):
-    # Extract lines which have been executed
-    script_lines = {}
+def _compile_substrings(paths):
+    # One regex which finds any of paths, so each script path is scanned once
+    # however many paths there are. An empty list never matches.
+    if paths is None:
+        return None
+    return re.compile('|'.join(map(re.escape, paths)) or '(?!)')
+
+
+class PathFilter:
+    '''The --only-paths, --ignore-paths and --replace-paths rules.
+
+    The rules are compiled once, and calling the filter with a script path
+    returns the path to record it under, or None if it is excluded. The
+    answer is memoised per distinct path, as a trace usually repeats a few
+    hundred paths millions of times.
+    '''
+
+    def __init__(self, path_include: List[str] =None, path_ignore: List[str] =None, path_replace: List[str] =None):
+        self._include = _compile_substrings(path_include)
+        self._ignore = _compile_substrings(path_ignore)
+        self._replace = [tuple(p.split(':', maxsplit=1))
+                         for p in path_replace or ()]
+        self._decisions = {}
+
+    def __call__(self, script):
+        try:
+            return self._decisions[script]
+        except KeyError:
+            decision = self._decisions[script] = self._decide(script)
+            return decision
+
+    def _decide(self, script):
+        # If this path hasn't been included in the allow list, ignore it
+        if self._include is not None and not self._include.search(script):
+            # TODO: Insert log.debug informing that this script is being ignored
+            return None
+
+        # If this script is in the ignore list, skip
+        if self._ignore is not None and self._ignore.search(script):
+            # TODO: Insert log.debug informing that this script is being ignored
+            return None
+
+        # Update the script path if required by the command line arguments.
+        # This might have been done because the location the script was run
+        # was different to where the coverage analysis is taking place, or
+        # because of bugs in BASH prior to 4.3alpha. Each replacement applies
+        # to the result of the previous one.
+        for search, replacement in self._replace:
+            script = script.replace(search, replacement)
+        return script
+
+
+def get_executed_lines(test_results, path_include: List[str] =None, path_ignore:List[str]=None,path_replace: List[str] =None, profile: dict =None):
+    '''Extract lines which have been executed.
+
+    test_results is an iterable of (stdout, stderr) pairs, where stderr is
+    either the whole trace as a string or an iterable of trace lines. Using
+    iterables keeps memory use flat for large traces. Lines may be str or
+    bytes, see iter_ps4_records.
+
+    Lines are gathered in sets, as adding to a set is cheaper than adding to
+    a LineSet record by record, and returned as LineSets.
+
+    If a profile dict is given, the hits and time of each line are added to
+    it, see merge_profiles. This is skipped otherwise as it slows parsing.
+    '''
+    ingester = _TraceIngester(path_include, path_ignore, path_replace,
+                              profile is not None)
     for r in test_results:
-        err = r[1].splitlines()
-        for line in err:
-            line = str(line)
-            if not (line.startswith('+')
-                    and line.strip('+').startswith("PS4 + ")):
-                continue
-            _, script, duration, line_number, _ = line.split(" + ", 4)
+        ingester.feed(r[1].splitlines() if isinstance(r[1], str) else r[1])
+        # Each trace is timed on its own
+        ingester.end_trace()
+    return ingester.result(profile)
+
+
+class _TraceIngester:
+    # The parsing behind get_executed_lines, for a trace fed in pieces as it
+    # arrives. The path decisions and the profiler's last record are kept
+    # between pieces.
+
+    def __init__(self, path_include=None, path_ignore=None, path_replace=None, profile=False):
+        self._path_filter = PathFilter(path_include, path_ignore, path_replace)
+        self._script_lines = {}
+        # The set of lines (or None if excluded) for each traced path, so the
+        # path rules don't have to be consulted for every record
+        self._targets = {}
+        # Profile of the traced paths, before the path rules are applied
+        self._stats = {} if profile else None
+        self._clock = [None, None]
+
+    def feed(self, lines):
+        script_lines = self._script_lines
+        path_filter = self._path_filter
+        targets = self._targets
+        records = iter_ps4_records(lines)
+        if self._stats is not None:
+            records = _profile_records(records, self._stats, self._clock)
+        for script, duration, line_number in records:
+            try:
+                target = targets[script]
+            except KeyError:
+                target = targets[script] = _get_target(script_lines,
+                                                       path_filter(script))
+            if target is not None:
+                target.add(line_number)
+
+    def end_trace(self):
+        self._clock = [None, None]
+
+    def result(self, profile=None):
+        '''Return the executed lines as LineSets, adding to profile if given.'''
+        for script, lines in (self._stats or {}).items():
+            script = self._path_filter(script)
+            if script is not None:
+                merge_profiles(profile, {script: lines})
+        return {script: LineSet(lines)
+                for script, lines in self._script_lines.items()}
+
+
+def _profile_records(records, stats, clock=None):
+    # Pass the PS4 records through, counting the hits and time of each line
+    # in stats. The time until the next record of the trace is charged to a
+    # line, so the last line of a trace gets none. clock, if given, carries
+    # the last record's [counts, time] over from the previous piece of the
+    # same trace and is updated for the next.
+    previous, started = clock or (None, None)
+    try:
+        for record in records:
+            script, clock_field, line_number = record
+            lines = stats.get(script)
+            if lines is None:
+                lines = stats[script] = {}
+            counts = lines.get(line_number)
+            if counts is None:
+                counts = lines[line_number] = [0, 0.0]
+            counts[0] += 1
+            now = _clock_seconds(clock_field)
+            if now is not None and started is not None:
+                previous[1] += max(now - started, 0.0)
+            previous, started = counts, now
+            yield record
+    finally:
+        if clock is not None:
+            clock[:] = [previous, started]
+
+
+def _clock_seconds(clock):
+    # The seconds in a PS4 clock field, e.g. '1697812345.123456S', or None
+    if isinstance(clock, bytes):
+        clock = clock.decode('ascii', errors='replace')
+    try:
+        # $EPOCHREALTIME uses the locale's decimal point
+        return float(clock.rstrip('S').replace(',', '.'))
+    except ValueError:
+        return None
+
+
+def merge_profiles(profile, other):
+    '''Merge the line profile in other into profile in place.
+
+    A profile maps each script to {line number: [hits, seconds]}.
+    '''
+    for script, lines in other.items():
+        target = profile.setdefault(script, {})
+        for line_number, (hits, seconds) in lines.items():
+            counts = target.get(line_number)
+            if counts is None:
+                target[line_number] = [hits, seconds]
+            else:
+                counts[0] += hits
+                counts[1] += seconds
+    return profile
 
-            # If this path hasn't been included in the allow list, ignore it
-            if path_include is not None and not any(p in script for p in path_include):
-                # TODO: Insert log.debug informing that this script is being ignored
-                continue
 
-            # If this script is in the ignore list, skip
-            if path_ignore is not None and any(p in script for p in path_ignore):
-                # TODO: Insert log.debug informing that this script is being ignored
-                continue
+def _get_target(script_lines, script):
+    # The set in script_lines which lines executed in script are added to
+    if script is None:
+        return None
+    return script_lines.setdefault(script, set())
 
-            # Update the script path if required by the command line arguments.
-            # This might have been done because the location the script was run was
-            # different to where the coverage analysis is taking place, or because of
-            # bugs in BASH prior to 4.3alpha.
-            if path_replace is not None:
-                for p in path_replace:
-                    search, replacement = p.split(':', maxsplit=1)
-                    script = script.replace(search, replacement)
 
-            line_number = int(line_number.replace('L', ''))
+def get_lines_in_script(text, engine: str ='regex'):
+    '''Return the set of line numbers in a script's text that can execute.
 
-            # Ignore line number 0 as its not a real line number
-            if line_number == 0:
-                continue
+    engine chooses between the regex strip pipeline and shell_lexer_lines.
+    '''
+    if engine == 'lexer':
+        return shell_lexer_lines(io.StringIO(text, newline=None).read())
+    lines_to_cover = set()
+    data = '\n'.join([l.strip() for l in io.StringIO(text, newline=None)])
 
-            # Update the scripts dictionary with the line number
-            if script in script_lines:
-                script_lines[script].add(line_number)
-            else:
-                script_lines[script] = {line_number}
-    return script_lines
+    # Remove items that are not counted as lines. The order of these
+    # operations does matter as the regex have not been designed to handle
+    # all permutations individually
+
+    # Remove escaped quotes
+    data = shell_strip_escaped_quotes(data)
+
+    # Remove comments from the script, replacing with empty strings
+    data = shell_strip_comments(data)
+
+    # Remove 'set -x' lines
+    data = shell_strip_xtrace(data)
+
+    # Adjust line continuation
+    data = shell_strip_line_continuation(data)
+
+    # Remove heredoc
+    data = shell_strip_heredoc(data)
 
+    # Change functions to blank lines
+    data = shell_strip_function(data)
 
-def get_lines_in_scripts(all_scripts):
+    # change multi-line quoted things to a single line and blank lines
+    data = shell_strip_multiline_quotes(data)
+
+    # Remove logic operators that don't count as lines
+    data = shell_strip_logic(data)
+    enumerator = enumerate(data.splitlines())
+
+    # Look at each line now
+    for line_number, line in enumerator:
+        # Ignore blank lines
+        if not line:
+            continue
+
+        # Ignore open/closing loop block items
+        lines_to_cover.add(line_number + 1)
+    return lines_to_cover
+
+
+def _cache_entry_path(cache_dir, raw, engine='regex'):
+    # The version, parser revision and engine are part of the key so results
+    # from a different parser are never reused
+    digest = hashlib.sha256(f'{VERSION}\0{PARSER_REVISION}\0{engine}\0'
+                            .encode('utf-8') + raw)
+    return os.path.join(cache_dir, digest.hexdigest())
+
+
+def _read_cache_entry(entry):
+    # A missing, unreadable or corrupt entry is a cache miss
+    try:
+        with open(entry, 'rb') as f:
+            lines = LineSet(_unpack_uint32_array(f.read()))
+    except (OSError, ValueError):
+        return None
+    try:
+        # Touch the entry so eviction removes the least recently used first.
+        # Another run may have just evicted it, or the cache may be read-only.
+        os.utime(entry)
+    except OSError:
+        pass
+    return lines
+
+
+@contextmanager
+def _atomic_path(path):
+    '''Yield a temporary path to write, which then replaces path in one step.
+
+    Readers never see path half written. The temporary file is named after
+    the process and thread, so concurrent writers never share one, and it is
+    removed if writing it fails.
+    '''
+    tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _write_cache_entry(entry, lines):
+    # Concurrent runs never see a partial entry. Caching is best effort, so
+    # a full or read-only cache just isn't written to.
+    try:
+        with _atomic_path(entry) as tmp, open(tmp, 'wb') as f:
+            f.write(_pack_uint32_array(sorted(lines)))
+    except OSError:
+        pass
+
+
+def evict_cache(cache_dir, max_bytes):
+    '''Remove the least recently used cache entries until under max_bytes.'''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.is_file():
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+        except FileNotFoundError:
+            # Evicted by a concurrent run
+            pass
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            # e.g. a read-only shared cache
+            continue
+        total -= size
+
+
+def _get_lines_in_script_file(script, cache_dir=None, engine='regex'):
+    with open(script, 'rb') as script_file:
+        raw = script_file.read()
+
+    entry = None
+    if cache_dir is not None:
+        entry = _cache_entry_path(cache_dir, raw, engine)
+        lines = _read_cache_entry(entry)
+        if lines is not None:
+            return lines
+
+    lines = LineSet(get_lines_in_script(raw.decode('utf-8', errors='replace'),
+                                        engine))
+    if entry is not None:
+        _write_cache_entry(entry, lines)
+    return lines
+
+
+def get_lines_in_scripts(all_scripts, cache_dir: str =None, cache_size: int =DEFAULT_CACHE_SIZE, engine: str ='regex', jobs: int =1):
+    '''Find the executable lines in each script using the given engine.
+
+    If cache_dir is given, results are cached there keyed by a hash of each
+    script's contents, so unchanged scripts skip the strip pipeline
+    entirely. The cache is trimmed to cache_size bytes afterwards.
+
+    Scripts are analysed in a pool of jobs processes (None for the number of
+    CPUs), sent in batches to keep the overhead down. The result is the same
+    as analysing them one by one.
+    '''
+    return dict(iter_lines_in_scripts(all_scripts, cache_dir, cache_size,
+                                      engine, jobs))
+
+
+def iter_lines_in_scripts(all_scripts, cache_dir: str =None, cache_size: int =DEFAULT_CACHE_SIZE, engine: str ='regex', jobs: int =1):
+    '''Yield (script, executable lines) for each script, in order, on demand.
+
+    This is the lazy form of get_lines_in_scripts. With more than one job
+    only a few batches per worker are queued ahead of the script being
+    yielded, so if the caller stops early the remaining scripts are never
+    analysed. The cache is trimmed once the generator finishes or is closed.
+    '''
     # Now check which lines matter
-    lines_to_cover = {script: set() for script in all_scripts}
+    all_scripts = list(all_scripts)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    analyse = partial(_get_lines_in_script_file, cache_dir=cache_dir,
+                      engine=engine)
+    jobs = jobs or os.cpu_count()
+    try:
+        if jobs == 1 or len(all_scripts) < 2:
+            for script in all_scripts:
+                yield script, analyse(script)
+            return
+
+        # Several batches per worker so one slow batch doesn't hold up the rest
+        size = max(1, len(all_scripts) // (jobs * 4))
+        batches = [all_scripts[i:i + size]
+                   for i in range(0, len(all_scripts), size)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            try:
+                for batch in batches:
+                    pending.append((batch, pool.submit(_analyse_batch,
+                                                       analyse, batch)))
+                    if len(pending) > jobs * 2:
+                        yield from _batch_results(pending.popleft())
+                while pending:
+                    yield from _batch_results(pending.popleft())
+            finally:
+                # Don't wait for batches nobody is going to read
+                for _, future in pending:
+                    future.cancel()
+    finally:
+        if cache_dir is not None:
+            evict_cache(cache_dir, cache_size)
+
+
+def _analyse_batch(analyse, batch):
+    return [analyse(script) for script in batch]
+
+
+def _batch_results(pending_batch):
+    batch, future = pending_batch
+    return zip(batch, future.result())
+
+
+def parse_unified_diff(lines):
+    '''Return {path: LineSet} of the lines each file has after a unified diff.
+
+    Only added and changed lines count, numbered as in the new file. Deleted
+    files are left out, and git's 'b/' prefix is removed from paths.
+    '''
+    changes = {}
+    added = None
+    # Lines left in the current hunk on the old and new sides
+    old_left = new_left = line_number = 0
+    for line in lines:
+        if old_left > 0 or new_left > 0:
+            if line.startswith('+'):
+                if added is not None:
+                    added.add(line_number)
+                line_number += 1
+                new_left -= 1
+            elif line.startswith('-'):
+                old_left -= 1
+            elif not line.startswith('\\'):
+                line_number += 1
+                old_left -= 1
+                new_left -= 1
+        elif line.startswith('+++ '):
+            path = line[4:].rstrip('\n').split('\t')[0]
+            if path == '/dev/null':
+                added = None
+            else:
+                if path.startswith('b/'):
+                    path = path[2:]
+                added = changes.setdefault(path, set())
+        else:
+            m = RE_DIFF_HUNK.match(line)
+            if m:
+                old_left = int(m.group(1) or 1)
+                line_number = int(m.group(2))
+                new_left = int(m.group(3) or 1)
+    return {path: LineSet(added) for path, added in changes.items()}
 
-    for script in all_scripts:
-        with open(script, 'r') as script_file:
-            data = '\n'.join([l.strip() for l in script_file.readlines()])
 
-        # Remove items that are not counted as lines. The order of these
-        # operations does matter as the regex have not been designed to handle
-        # all permutations individually
+def get_changes(diff: str =None, changed: List[str] =None):
+    '''Return {absolute path: LineSet, or None for every line} of changes.
+
+    diff is a unified diff file, see parse_unified_diff, and changed is a
+    list of scripts which have changed throughout.
+    '''
+    changes = {}
+    if diff is not None:
+        with open(diff, encoding='utf-8', errors='replace') as f:
+            for path, lines in parse_unified_diff(f).items():
+                changes[os.path.abspath(path)] = lines
+    for path in changed or ():
+        changes[os.path.abspath(path)] = None
+    return changes
 
-        # Remove escaped quotes
-        data = shell_strip_escaped_quotes(data)
 
-        # Remove comments from the script, replacing with empty strings
-        data = shell_strip_comments(data)
+def restrict_to_changes(script_lines, changes):
+    '''Return only the changed scripts, and lines, in script_lines.
 
-        # Remove 'set -x' lines
-        data = shell_strip_xtrace(data)
+    Changed shell scripts (by SCRIPT_SUFFIXES) which are not
+    in script_lines are added with no lines, as nothing ran them.
+    '''
+    restricted = dict(iter_changed_lines(script_lines.items(), changes))
+    found = {os.path.abspath(script) for script in restricted}
+    for key in changes:
+        if (key not in found and key.endswith(SCRIPT_SUFFIXES)
+                and os.path.isfile(key)):
+            restricted[key] = LineSet()
+    return restricted
 
-        # Adjust line continuation
-        data = shell_strip_line_continuation(data)
 
-        # Remove heredoc
-        data = shell_strip_heredoc(data)
+def iter_changed_lines(script_lines, changes):
+    '''Yield (script, changed lines) for changed scripts in script_lines.
 
-        # Change functions to blank lines
-        data = shell_strip_function(data)
+    script_lines is an iterable of (script, lines) pairs, such as
+    iter_lines_in_scripts yields, so it is only read as far as needed.
+    '''
+    for script, lines in script_lines:
+        key = os.path.abspath(script)
+        if key in changes:
+            changed = changes[key]
+            yield script, (LineSet(lines) if changed is None
+                           else changed.intersection(lines))
 
-        # change multi-line quoted things to a single line and blank lines
-        data = shell_strip_multiline_quotes(data)
 
-        # Remove logic operators that don't count as lines
-        data = shell_strip_logic(data)
-        enumerator = enumerate(data.splitlines())
+def _compile_name_patterns(patterns):
+    # One regex matching a file name against any of the fnmatch patterns
+    return re.compile('|'.join(map(fnmatch.translate, patterns))
+                      or '(?!)').match
 
-        # Look at each line now
-        for line_number, line in enumerator:
-            # Ignore blank lines
-            if not line:
-                continue
 
-            # Ignore open/closing loop block items
-            lines_to_cover[script].add(line_number + 1)
-    return lines_to_cover
+def find_scripts(search_path, patterns: List[str] =DEFAULT_TEST_PATTERNS, ignore: List[str] =(), index: dict =None):
+    '''Return the sorted test scripts under search_path, or [search_path] for a file.
 
+    The tree is walked once with os.scandir, returning the files whose names
+    match any of the fnmatch patterns and skipping files and directories
+    whose names match any in ignore. Symbolic links to directories are not
+    followed.
 
-def find_scripts(search_path):
+    index, from load_script_index, remembers the matching files and the
+    subdirectories of each directory walked by its mtime. An unchanged
+    directory is then only stat'ed rather than listed again. A directory's
+    mtime only covers its own entries, so each subdirectory is still checked.
+    '''
     if os.path.isfile(search_path):
-        return search_path
+        return [search_path]
+    match = _compile_name_patterns(patterns)
+    skip = _compile_name_patterns(ignore)
     results = []
-    for suffix in ('sh', 'bash', 'ksh'):
-        results.extend(Path(search_path).rglob(f'test_*.{suffix}'))
-    return results
+    pending = [os.fspath(search_path)]
+    while pending:
+        directory = pending.pop()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        key = os.path.abspath(directory)
+        cached = None if index is None else index['dirs'].get(key)
+        if cached is not None and cached[0] == mtime:
+            _, files, subdirs = cached
+        else:
+            files = []
+            subdirs = []
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if skip(entry.name):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif match(entry.name) and entry.is_file():
+                            files.append(entry.name)
+            except OSError:
+                continue
+            if index is not None and time.time_ns() - mtime > _RACY_MTIME_NS:
+                index['dirs'][key] = [mtime, files, subdirs]
+        results.extend(Path(directory, name) for name in files)
+        pending.extend(os.path.join(directory, name) for name in subdirs)
+    # Directory order depends on the file system, sort it so runs are repeatable
+    return sorted(results)
 
 
-def run_test_scripts(test_paths: List[str], path_include: List[str] =None,path_ignore:List[str]=None, path_replace: List[str] =None) -> Dict[str, int]:
+def load_script_index(path, patterns: List[str] =DEFAULT_TEST_PATTERNS, ignore: List[str] =()) -> dict:
+    '''Return the find_scripts index saved in path, or a new one.
+
+    An index saved with different patterns or ignore rules is not reused.
+    '''
+    key = [VERSION, list(patterns), list(ignore)]
+    try:
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = None
+    if not isinstance(index, dict) or index.get('key') != key:
+        index = {'key': key, 'dirs': {}}
+    return index
+
+
+def save_script_index(path, index):
+    with _atomic_path(path) as tmp, open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+
+
+def find_test_scripts(test_paths: List[str], patterns: List[str] =DEFAULT_TEST_PATTERNS, ignore: List[str] =(), index_file: str =None):
+    '''Return the test scripts found by find_scripts in each of test_paths.
+
+    With index_file, the directory index is loaded from and saved to it.
+    '''
+    index = None
+    if index_file is not None:
+        index = load_script_index(index_file, patterns, ignore)
+    test_scripts = []
+    for p in test_paths:
+        test_scripts.extend(find_scripts(p, patterns, ignore, index))
+    if index is not None:
+        save_script_index(index_file, index)
+    return test_scripts
+
+
+def merge_script_lines(script_lines, other):
+    '''Merge the executed lines in other into script_lines in place.'''
+    for script, lines in other.items():
+        if script in script_lines:
+            script_lines[script].update(lines)
+        else:
+            script_lines[script] = LineSet(lines)
+    return script_lines
+
+
+def run_test_scripts(test_paths: List[str], path_include: List[str] =None,path_ignore:List[str]=None, path_replace: List[str] =None, jobs: int =None, timeout: float =None, xtrace_fd: bool =False, profile: dict =None, contexts: 'TestContexts' =None) -> Dict[str, int]:
+    '''Run the test scripts found in test_paths and collect executed lines.
+
+    Up to jobs test scripts (default: the number of CPUs) are run at the same
+    time. Each script's trace is parsed by the worker running it, and the
+    partial results are merged in test script order so the output does not
+    depend on which script finishes first. Any test script still running
+    after timeout seconds is killed. With xtrace_fd the trace is captured
+    through BASH_XTRACEFD rather than stderr. A profile dict is filled in as
+    for get_executed_lines, and contexts with the lines each test executed.
+    '''
     test_scripts = []
 
     for p in test_paths:
         test_scripts.extend(find_scripts(p))
 
-    test_results = get_test_results(test_scripts)
-    return get_executed_lines(output, path_include, path_ignore, path_replace)
+    if jobs == 1 or not sys.stdin.isatty():
+        test_results = get_test_results(test_scripts, timeout, xtrace_fd)
+        if contexts is None:
+            return get_executed_lines(test_results, path_include, path_ignore, path_replace, profile)
+        # A trace piped in on stdin is one context, named '-'
+        tests = map(str, test_scripts) if sys.stdin.isatty() else ['-']
+        script_lines = {}
+        for test, test_result in zip(tests, test_results):
+            lines = get_executed_lines([test_result], path_include, path_ignore, path_replace, profile)
+            contexts.add(test, lines)
+            merge_script_lines(script_lines, lines)
+        return script_lines
+
+    use_env = _get_test_env()
+
+    def run_one(script):
+        # Each thread profiles into its own dict, merged below
+        script_profile = None if profile is None else {}
+        lines = get_executed_lines([_run_test_script(script, use_env, timeout,
+                                                     xtrace_fd)],
+                                   path_include, path_ignore, path_replace,
+                                   script_profile)
+        return lines, script_profile
 
+    script_lines = {}
+    # Threads are enough as the tests themselves run in child processes
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for script, (partial, script_profile) in zip(
+                test_scripts, pool.map(run_one, test_scripts)):
+            if contexts is not None:
+                contexts.add(str(script), partial)
+            merge_script_lines(script_lines, partial)
+            if profile is not None:
+                merge_profiles(profile, script_profile)
+    return script_lines
 
-def get_script_lines_from_canned_results(canned_results: List[str],path_include: List[str] =None,path_ignore:List[str]=None, path_replace: List[str] =None) -> Dict[str, int]:
-    output = [_read_canned_results(p) for p in canned_results]
-    return get_executed_lines(output, path_include, path_ignore, path_replace)
 
+def run_test_scripts_async(test_paths: List[str], path_include: List[str] =None,path_ignore:List[str]=None, path_replace: List[str] =None, jobs: int =None, timeout: float =None, xtrace_fd: bool =False, profile: dict =None, fail_fast: bool =False, contexts: 'TestContexts' =None):
+    '''Run the test scripts with asyncio, returning (script lines, failed).
 
-def _read_canned_results(canned_result: str) -> str:
-    with open(canned_result) as f:
-         return ('', f.read())
+    This is an alternative to run_test_scripts taking the same arguments.
+    Up to jobs tests run at once, limited by a semaphore, and each test's
+    trace is parsed in chunks as it arrives. A line is printed to stderr as
+    each test finishes, with its outcome and elapsed time, and every
+    PROGRESS_INTERVAL seconds for each test still running, so slow or hung
+    tests show up while the rest carry on.
+
+    failed lists the test scripts which exited with a non-zero status or
+    timed out. With fail_fast, the first failure kills the running tests and
+    no more are started, and the lines traced until then are returned.
+    '''
+    if not sys.stdin.isatty():
+        # The trace is being piped in rather than run here
+        return run_test_scripts(test_paths, path_include, path_ignore,
+                                path_replace, 1, timeout, xtrace_fd,
+                                profile, contexts), []
+    test_scripts = []
+    for p in test_paths:
+        test_scripts.extend(find_scripts(p))
+    filters = (path_include, path_ignore, path_replace)
+    return asyncio.run(_run_tests_async(test_scripts, filters, jobs, timeout,
+                                        xtrace_fd, profile, fail_fast,
+                                        contexts))
+
+
+async def _run_tests_async(test_scripts, filters, jobs, timeout, xtrace_fd, profile, fail_fast, contexts):
+    semaphore = asyncio.Semaphore(jobs or os.cpu_count())
+    progress = _Progress(len(test_scripts))
+    env = _get_test_env()
+    # Set by the first failure when failing fast, which stops the running
+    # tests and any not yet started
+    stopping = asyncio.Event() if fail_fast else None
+    failed = []
+
+    tasks = [asyncio.ensure_future(_run_test_async(
+                 str(script), env, semaphore, filters, timeout, xtrace_fd,
+                 profile is not None, progress, stopping))
+             for script in test_scripts]
+    reporter = asyncio.ensure_future(progress.report_running())
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    reporter.cancel()
+
+    script_lines = {}
+    # Merged in test script order so the result doesn't depend on timing
+    for script, result in zip(test_scripts, results):
+        if isinstance(result, BaseException):
+            raise result
+        if result is None:
+            # Not started, as an earlier test failed
+            continue
+        lines, test_profile, test_failed = result
+        if contexts is not None:
+            contexts.add(str(script), lines)
+        merge_script_lines(script_lines, lines)
+        if profile is not None:
+            merge_profiles(profile, test_profile)
+        if test_failed:
+            failed.append(test_failed)
+    return script_lines, failed
+
+
+async def _run_test_async(script, env, semaphore, filters, timeout, xtrace_fd, profile, progress, stopping=None):
+    # Run one test once the semaphore allows, parsing its trace as it
+    # arrives. Returns (lines, profile, script if it failed else None), or
+    # None if stopping was set before the test started. The timeout covers
+    # the whole test, and the test is killed (keeping the lines traced so
+    # far) if it runs out or stopping is set.
+    if not os.path.isfile(script):
+        raise OSError('"{}" does not exist, aborting!'.format(script))
+    async with semaphore:
+        if stopping is not None and stopping.is_set():
+            return None
+        loop = asyncio.get_event_loop()
+        kwargs = {}
+        if xtrace_fd:
+            read_fd, write_fd = os.pipe()
+            args = BASH_CMD + [script]
+            env = dict(env, BASH_XTRACEFD=str(write_fd))
+            kwargs = {'stderr': None, 'pass_fds': (write_fd,)}
+        else:
+            args = BASE_CMD + [script]
+            kwargs = {'stderr': asyncio.subprocess.PIPE}
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, env=env, stdout=asyncio.subprocess.PIPE,
+                start_new_session=True, **kwargs)
+        finally:
+            if xtrace_fd:
+                os.close(write_fd)
+        transport = None
+        if xtrace_fd:
+            trace = asyncio.StreamReader()
+            transport, _ = await loop.connect_read_pipe(
+                lambda: asyncio.StreamReaderProtocol(trace),
+                os.fdopen(read_fd, 'rb'))
+        else:
+            trace = proc.stderr
+        progress.start(script)
+        stdout_tail = deque(maxlen=STDOUT_TAIL_LINES)
+        drain = asyncio.ensure_future(_drain_stream_async(proc.stdout,
+                                                          stdout_tail))
+        ingester = _TraceIngester(*filters, profile)
+        run = asyncio.ensure_future(asyncio.gather(
+            _ingest_stream(trace, ingester), proc.wait(), drain))
+        waiting = {run}
+        if stopping is not None:
+            waiting.add(asyncio.ensure_future(stopping.wait()))
+        outcome = None
+        try:
+            await asyncio.wait(waiting, timeout=timeout,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not run.done():
+                outcome = 'TIMEOUT'
+                if stopping is not None and stopping.is_set():
+                    outcome = 'STOPPED'
+                else:
+                    _warn_timed_out(script, timeout, stdout_tail)
+        finally:
+            for waiter in waiting - {run}:
+                waiter.cancel()
+            if not run.done():
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                # Read what is left of the trace, unless something outside
+                # the process group holds the pipe open
+                await asyncio.wait({run}, timeout=KILL_GRACE)
+                run.cancel()
+                await proc.wait()
+            if transport is not None:
+                transport.close()
+        if outcome is None:
+            run.result()
+            status = proc.returncode
+            outcome = 'ok' if status == 0 else f'FAILED (exit {status})'
+        progress.finish(script, outcome)
+        if outcome not in ('ok', 'STOPPED') and stopping is not None:
+            stopping.set()
+    test_profile = {} if profile else None
+    script_lines = ingester.result(test_profile)
+    # A test stopped by another's failure hasn't failed itself
+    return (script_lines, test_profile,
+            None if outcome in ('ok', 'STOPPED') else script)
+
+
+async def _drain_stream_async(stream, tail):
+    # Keep the pipe empty so the child can never block writing to it
+    while True:
+        line = await stream.readline()
+        if not line:
+            return
+        tail.append(line)
+
+
+async def _ingest_stream(stream, ingester):
+    # Feed the trace to ingester in chunks as they arrive, joining up any
+    # line split between two chunks
+    partial_line = b''
+    try:
+        while True:
+            chunk = await stream.read(TRACE_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (partial_line + chunk).split(b'\n')
+            partial_line = lines.pop()
+            ingester.feed(lines)
+    finally:
+        # Keep what was traced before a timeout or cancellation
+        if partial_line:
+            ingester.feed([partial_line])
+
+
+class _Progress:
+    # Per-test progress lines for run_test_scripts_async
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.running = {}
+
+    def start(self, script):
+        self.running[script] = time.monotonic()
+
+    def finish(self, script, outcome):
+        elapsed = time.monotonic() - self.running.pop(script)
+        self.done += 1
+        width = len(str(self.total))
+        print(f'[{self.done:{width}}/{self.total}] {outcome} {script} '
+              f'({elapsed:.1f}s)', file=sys.stderr)
+
+    async def report_running(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            now = time.monotonic()
+            for script, started in list(self.running.items()):
+                print(f'[running] {script} ({now - started:.0f}s)',
+                      file=sys.stderr)
+
+
+def get_script_lines_from_canned_results(canned_results: List[str],path_include: List[str] =None,path_ignore:List[str]=None, path_replace: List[str] =None, jobs: int =1, profile: dict =None) -> Dict[str, int]:
+    '''Collect executed lines from raw -x traces and/or binary traces.
+
+    The traces are read in a pool of jobs processes (None for the number of
+    CPUs), with large text traces split into byte ranges on line boundaries
+    so a single huge trace is spread across them too. Each worker sends back
+    its partial result as LineSets, which pickle as one int per script, and
+    they are merged here. The result is the same as reading the traces one
+    by one.
+
+    A profile dict is filled in as for get_executed_lines. Binary traces
+    carry no timing, and time spanning two byte ranges is not counted.
+    '''
+    read = partial(_get_canned_lines, path_include=path_include,
+                   path_ignore=path_ignore, path_replace=path_replace,
+                   profile=profile is not None)
+    script_lines = {}
+    jobs = jobs or os.cpu_count()
+    if jobs == 1:
+        for p in canned_results:
+            _merge_canned_lines(script_lines, profile, read((p, 0, None)))
+        return script_lines
+
+    shards = _split_canned_results(canned_results, jobs)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for partial_result in pool.map(read, shards):
+            _merge_canned_lines(script_lines, profile, partial_result)
+    return script_lines
+
+
+def _merge_canned_lines(script_lines, profile, partial_result):
+    lines, shard_profile = partial_result
+    merge_script_lines(script_lines, lines)
+    if profile is not None:
+        merge_profiles(profile, shard_profile)
+
+
+def _split_canned_results(canned_results, jobs):
+    # (path, start, stop) shards, with large text traces split into about
+    # jobs * 4 ranges in all (but none smaller than CANNED_SHARD_SIZE) so the
+    # work stays balanced. Binary traces are small and are read whole.
+    sizes = {}
+    for p in canned_results:
+        sizes[p] = 0 if is_binary_trace(p) else os.path.getsize(p)
+    shard_size = max(CANNED_SHARD_SIZE, sum(sizes.values()) // (jobs * 4))
+    shards = []
+    for p in canned_results:
+        if sizes[p] <= shard_size:
+            shards.append((p, 0, None))
+        else:
+            shards.extend((p, start, start + shard_size)
+                          for start in range(0, sizes[p], shard_size))
+    return shards
+
+
+def _get_canned_lines(shard, path_include=None, path_ignore=None, path_replace=None, profile=False):
+    # The executed lines, and profile if wanted, in one (path, start, stop)
+    # shard of the canned results
+    path, start, stop = shard
+    shard_profile = {} if profile else None
+    if is_binary_trace(path):
+        path_filter = PathFilter(path_include, path_ignore, path_replace)
+        lines = {}
+        for script, executed in read_binary_trace(path).items():
+            script = path_filter(script)
+            if script is not None:
+                merge_script_lines(lines, {script: executed})
+        return lines, shard_profile
+    trace = _iter_file_lines(path, start=start, stop=stop)
+    lines = get_executed_lines([('', trace)], path_include, path_ignore,
+                               path_replace, shard_profile)
+    return lines, shard_profile
+
+
+def _uint32_array(values=()):
+    # 'I' is 4 bytes on every mainstream platform, but it is only guaranteed
+    # to be at least 2
+    typecode = 'I' if array('I').itemsize == 4 else 'L'
+    return array(typecode, values)
+
+
+def _pack_uint32_array(values):
+    packed = _uint32_array(values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_uint32_array(data):
+    unpacked = _uint32_array()
+    unpacked.frombytes(data)
+    if sys.byteorder != 'little':
+        unpacked.byteswap()
+    return unpacked
+
+
+def _write_section(f, tag, payload):
+    f.write(tag + _SECTION_LENGTH.pack(len(payload)) + payload)
+
+
+def write_binary_trace(path, script_lines, contexts: 'TestContexts' =None):
+    '''Write executed lines to path in the compact binary trace format.
+
+    The file starts with BINARY_MAGIC and a format version, followed by
+    tagged sections (4 byte tag, uint64 length, payload) so new sections can
+    be added without breaking older readers, which skip unknown tags. All
+    integers are little endian.
+
+    STRS: uint32 count, then per string a uint32 length and UTF-8 bytes.
+          Script paths are stored once here and referenced by index.
+    LINE: uint32 count, then per script its uint32 string index, uint32
+          number of lines and the sorted line numbers as packed uint32s.
+    CTXT: only written with contexts. uint32 number of tests and their
+          string indices, which give each test its id, then uint32 number
+          of scripts and per script its string index and uint32 number of
+          lines, and per line its number, uint32 number of tests and the
+          sorted ids of the tests which executed it.
+    '''
+    scripts = list(script_lines)
+    string_index = {script: index for index, script in enumerate(scripts)}
+    if contexts is not None:
+        for name in chain(contexts.tests, contexts.scripts()):
+            string_index.setdefault(name, len(string_index))
+    string_table = [_pack_uint32_array([len(string_index)])]
+    for string in string_index:
+        encoded = string.encode('utf-8')
+        string_table.extend((_pack_uint32_array([len(encoded)]), encoded))
+    line_table = [_pack_uint32_array([len(scripts)])]
+    for index, script in enumerate(scripts):
+        lines = sorted(script_lines[script])
+        line_table.append(_pack_uint32_array([index, len(lines)] + lines))
+
+    with open(path, 'wb') as f:
+        f.write(BINARY_MAGIC + _FORMAT_VERSION.pack(BINARY_FORMAT_VERSION))
+        _write_section(f, b'STRS', b''.join(string_table))
+        _write_section(f, b'LINE', b''.join(line_table))
+        if contexts is not None:
+            _write_section(f, b'CTXT',
+                           _pack_contexts(contexts, string_index))
+
+
+def _pack_contexts(contexts, string_index):
+    table = [len(contexts.tests)]
+    table.extend(string_index[test] for test in contexts.tests)
+    scripts = contexts.scripts()
+    table.append(len(scripts))
+    for script in scripts:
+        line_tests = contexts.line_tests(script)
+        table.extend((string_index[script], len(line_tests)))
+        for line_number, test_ids in line_tests:
+            table.extend((line_number, len(test_ids)))
+            table.extend(test_ids)
+    return _pack_uint32_array(table)
+
+
+def is_binary_trace(path):
+    # Only regular files are sniffed, as reading a pipe would consume the
+    # start of a text trace
+    if not stat.S_ISREG(os.stat(path).st_mode):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def _read_sections(path):
+    with open(path, 'rb') as f:
+        header = f.read(len(BINARY_MAGIC) + _FORMAT_VERSION.size)
+        if not header.startswith(BINARY_MAGIC):
+            raise ValueError(f'"{path}" is not a shellcov binary trace')
+        version, = _FORMAT_VERSION.unpack(header[len(BINARY_MAGIC):])
+        if version > BINARY_FORMAT_VERSION:
+            raise ValueError(f'"{path}" uses binary trace format {version}, '
+                             f'only {BINARY_FORMAT_VERSION} is supported')
+        sections = {}
+        while True:
+            tag = f.read(4)
+            if not tag:
+                return sections
+            length, = _SECTION_LENGTH.unpack(f.read(_SECTION_LENGTH.size))
+            sections[tag] = f.read(length)
+
+
+def _unpack_strings(data):
+    count = _unpack_uint32_array(data[:4])[0]
+    strings = []
+    offset = 4
+    for _ in range(count):
+        length = _unpack_uint32_array(data[offset:offset + 4])[0]
+        offset += 4
+        strings.append(data[offset:offset + length].decode('utf-8'))
+        offset += length
+    return strings
+
+
+def read_binary_trace(path):
+    '''Read the executed lines stored by write_binary_trace.'''
+    sections = _read_sections(path)
+    strings = _unpack_strings(sections[b'STRS'])
+    table = _unpack_uint32_array(sections[b'LINE'])
+    script_lines = {}
+    offset = 1
+    for _ in range(table[0]):
+        index, count = table[offset], table[offset + 1]
+        offset += 2
+        script_lines[strings[index]] = LineSet(table[offset:offset + count])
+        offset += count
+    return script_lines
+
+
+def read_binary_contexts(path):
+    '''Read the test contexts stored by write_binary_trace.
+
+    A trace written without contexts gives an empty TestContexts.
+    '''
+    sections = _read_sections(path)
+    contexts = TestContexts()
+    if b'CTXT' not in sections:
+        return contexts
+    strings = _unpack_strings(sections[b'STRS'])
+    table = _unpack_uint32_array(sections[b'CTXT'])
+    count = table[0]
+    contexts.tests = [strings[index] for index in table[1:count + 1]]
+    contexts._ids = {test: i for i, test in enumerate(contexts.tests)}
+    offset = count + 2
+    for _ in range(table[count + 1]):
+        script, count = strings[table[offset]], table[offset + 1]
+        offset += 2
+        lines = contexts._lines[script] = {}
+        for _ in range(count):
+            line_number, test_count = table[offset], table[offset + 1]
+            offset += 2
+            lines[line_number] = LineSet(table[offset:offset + test_count])
+            offset += test_count
+    return contexts
+
+
+class TestContexts:
+    '''Which tests executed each line, to answer "who covers this line?".
+
+    Each test gets an id, its index in tests, and each executed line of each
+    script maps to a LineSet of the ids of the tests which executed it, so
+    each extra test covering a line costs a bit.
+    '''
+    def __init__(self):
+        self.tests = []
+        self._ids = {}
+        self._lines = {}
+
+    def __len__(self):
+        return len(self.tests)
+
+    def _test_id(self, test):
+        test_id = self._ids.get(test)
+        if test_id is None:
+            test_id = self._ids[test] = len(self.tests)
+            self.tests.append(test)
+        return test_id
+
+    def add(self, test, script_lines):
+        '''Record that test executed script_lines.'''
+        test_id = self._test_id(test)
+        for script, lines in script_lines.items():
+            script_contexts = self._lines.setdefault(script, {})
+            for line_number in lines:
+                test_ids = script_contexts.get(line_number)
+                if test_ids is None:
+                    test_ids = script_contexts[line_number] = LineSet()
+                test_ids.add(test_id)
+
+    def discard(self, *tests):
+        '''Forget the lines the tests executed, e.g. before they run again.'''
+        mask = LineSet(self._ids[test] for test in tests if test in self._ids)
+        if not mask:
+            return
+        # One pass over every line, however many tests are forgotten
+        for script_contexts in self._lines.values():
+            for test_ids in script_contexts.values():
+                test_ids.difference_update(mask)
+
+    def merge(self, other):
+        '''Merge other into these contexts in place.
+
+        A test in both keeps only the lines from other, as a test which has
+        been run again replaces what it covered before.
+        '''
+        self.discard(*other.tests)
+        id_map = [self._test_id(test) for test in other.tests]
+        # The usual case, the same tests run again, needs no renumbering
+        same_ids = id_map == list(range(len(id_map)))
+        for script, script_contexts in other._lines.items():
+            target = self._lines.setdefault(script, {})
+            for line_number, test_ids in script_contexts.items():
+                mapped = (test_ids.copy() if same_ids else
+                          LineSet(id_map[test_id] for test_id in test_ids))
+                if line_number in target:
+                    target[line_number].update(mapped)
+                else:
+                    target[line_number] = mapped
+        return self
+
+    def scripts(self):
+        return list(self._lines)
+
+    def line_tests(self, script):
+        '''Return the sorted (line number, test ids) covered in script.'''
+        return [(line_number, test_ids) for line_number, test_ids
+                in sorted(self._lines.get(script, {}).items()) if test_ids]
+
+    def who_covers(self, script, line_number) -> List[str]:
+        '''Return the tests which executed line_number of script.'''
+        test_ids = self._lines.get(script, {}).get(line_number, ())
+        return [self.tests[test_id] for test_id in test_ids]
+
+    def covering_tests(self, script, lines=None) -> List[str]:
+        '''Return the tests which executed any of lines (default: any line) of script.'''
+        script_contexts = self._lines.get(script, {})
+        if lines is None:
+            lines = script_contexts
+        test_ids = LineSet()
+        for line_number in lines:
+            test_ids.update(script_contexts.get(line_number, ()))
+        return [self.tests[test_id] for test_id in test_ids]
+
+
+class CoverageCollector:
+    '''Executed lines gathered incrementally from traces which are still running.
+
+    Any number of threads can add traces at once while others take
+    snapshots. The path rules are applied as for get_executed_lines, and
+    engine and cache_dir are used for snapshot reports.
+    '''
+
+    def __init__(self, path_include: List[str] =None, path_ignore: List[str] =None, path_replace: List[str] =None, engine: str ='regex', cache_dir: str =None):
+        self.engine = engine
+        self.cache_dir = cache_dir
+        self._path_filter = PathFilter(path_include, path_ignore, path_replace)
+        self._script_lines = {}
+        self._lock = threading.Lock()
+
+    def add_trace(self, lines):
+        '''Add the PS4 records in lines, which may block waiting for more.'''
+        # This trace's path decisions, as for get_executed_lines
+        targets = {}
+        for script, _, line_number in iter_ps4_records(lines):
+            with self._lock:
+                try:
+                    target = targets[script]
+                except KeyError:
+                    target = targets[script] = _get_target(
+                        self._script_lines, self._path_filter(script))
+                if target is not None:
+                    target.add(line_number)
+
+    def merge(self, script_lines):
+        with self._lock:
+            for script, lines in script_lines.items():
+                self._script_lines.setdefault(script, set()).update(lines)
+
+    def snapshot(self):
+        '''Return a copy of the executed lines collected so far.'''
+        with self._lock:
+            return {script: LineSet(lines)
+                    for script, lines in self._script_lines.items()}
+
+    def write_report(self, report_format, f):
+        script_lines = self.snapshot()
+        lines_to_cover = iter_lines_in_scripts(list(script_lines),
+                                               self.cache_dir,
+                                               engine=self.engine)
+        write_report(report_format, lines_to_cover, script_lines, f)
+
+
+class _CollectorHandler(socketserver.StreamRequestHandler):
+    # A connection either sends trace lines, or asks for a report with
+    # 'REPORT <format>' as its first line
+    def handle(self):
+        first = self.rfile.readline()
+        if first.startswith(b'REPORT'):
+            words = first.split()
+            report_format = words[1].decode() if len(words) > 1 else 'text'
+            report = io.TextIOWrapper(self.wfile, encoding='utf-8')
+            try:
+                if report_format in REPORT_FORMATS:
+                    self.server.collector.write_report(report_format, report)
+                else:
+                    report.write(f'Unknown report format {report_format!r}\n')
+            finally:
+                # Leave closing the connection to the server
+                report.flush()
+                report.detach()
+        else:
+            self.server.collector.add_trace(chain((first,), self.rfile))
+
+
+class _CollectorServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def start_collector(collector, socket_path: str =None, fifo_path: str =None):
+    '''Feed collector from a Unix socket and/or a FIFO in background threads.
+
+    Returns a function which stops collecting and removes the socket.
+    '''
+    stoppers = []
+    threads = []
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _CollectorServer(socket_path, _CollectorHandler)
+        server.collector = collector
+        threads.append(threading.Thread(target=server.serve_forever,
+                                        daemon=True))
+
+        def stop_server():
+            server.shutdown()
+            server.server_close()
+            os.remove(socket_path)
+        stoppers.append(stop_server)
+    if fifo_path is not None:
+        if not os.path.exists(fifo_path):
+            os.mkfifo(fifo_path)
+        stopping = threading.Event()
+        threads.append(threading.Thread(
+            target=_read_fifo, args=(collector, fifo_path, stopping),
+            daemon=True))
+
+        def stop_fifo():
+            stopping.set()
+            # Wake the reader if it is waiting for a writer to open the FIFO
+            try:
+                os.close(os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+        stoppers.append(stop_fifo)
+    for thread in threads:
+        thread.start()
+
+    def stop():
+        for stopper in stoppers:
+            stopper()
+    return stop
+
+
+def _read_fifo(collector, fifo_path, stopping):
+    # Each open lasts until the last writer closes the FIFO, so reopen it
+    # for the next ones
+    while not stopping.is_set():
+        with open(fifo_path, 'rb') as fifo:
+            collector.add_trace(fifo)
+
+
+def request_snapshot(socket_path, report_format: str ='text') -> str:
+    '''Return a report of what the collector listening on socket_path has seen.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(f'REPORT {report_format}\n'.encode())
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as response:
+            return response.read().decode('utf-8')
+
+
+def update_data_file(data_file, script_lines, append: bool =False, contexts: TestContexts =None):
+    '''Save script_lines to a coverage data file and return what was saved.
+
+    A data file is a binary trace. With append, the lines already in
+    data_file (if it exists) are merged in first, so the file accumulates
+    coverage across runs, and so are its test contexts, which those of the
+    tests run again replace. The file is replaced in one step, so a reader
+    never sees it half written.
+    '''
+    if append and os.path.exists(data_file):
+        script_lines = merge_script_lines(read_binary_trace(data_file),
+                                          script_lines)
+        saved_contexts = read_binary_contexts(data_file)
+        if contexts is not None:
+            saved_contexts.merge(contexts)
+        contexts = saved_contexts or contexts
+    with _atomic_path(data_file) as tmp:
+        write_binary_trace(tmp, script_lines, contexts)
+    return script_lines
+
+
+def combine_data_files(data_file, paths, append: bool =False):
+    '''Merge the data files (or binary traces) in paths into data_file.'''
+    script_lines = {}
+    contexts = TestContexts()
+    for p in paths:
+        merge_script_lines(script_lines, read_binary_trace(p))
+        contexts.merge(read_binary_contexts(p))
+    return update_data_file(data_file, script_lines, append,
+                            contexts or None)
+
+
+def iter_who_covers(contexts, locations: List[str] =None):
+    '''Yield (script, line number, tests) for each covered line in locations.
+
+    A location is a script path, or 'script:line'. Scripts are matched by
+    their absolute paths. Without locations, every covered line is yielded.
+    '''
+    scripts = {os.path.abspath(script): script
+               for script in contexts.scripts()}
+    if locations is None:
+        wanted = [(script, None) for script in contexts.scripts()]
+    else:
+        wanted = []
+        for location in locations:
+            path, _, line_number = location.rpartition(':')
+            if not (path and line_number.isdigit()):
+                path, line_number = location, None
+            script = scripts.get(os.path.abspath(path))
+            if script is not None:
+                wanted.append((script, line_number and int(line_number)))
+    for script, wanted_line in wanted:
+        for line_number, test_ids in contexts.line_tests(script):
+            if wanted_line is None or line_number == wanted_line:
+                yield (script, line_number,
+                       [contexts.tests[test_id] for test_id in test_ids])
+
+
+def select_tests(test_scripts, contexts, changes):
+    '''Return the test scripts affected by changes, in the order to run them.
+
+    contexts are those stored by an earlier run and changes are as from
+    get_changes. A test is affected if it changed, if it has no stored
+    contexts, or if it executed a changed line. Line numbers move as a script
+    is edited, so when none of a script's changed lines were executed (e.g.
+    they are all new) every test which executed the script is affected.
+
+    Changed and unknown tests run first, being the most likely to fail. The
+    rest are ordered greedily, each covering the most changed lines not
+    covered by the tests before it, so the changes are exercised as early
+    as possible. Ties keep the order of test_scripts.
+    '''
+    scripts = {os.path.abspath(script): script
+               for script in contexts.scripts()}
+    # The changed (script, line) pairs each known test executed
+    test_changes = {os.path.abspath(test): set() for test in contexts.tests}
+    for key, changed in changes.items():
+        script = scripts.get(key)
+        if script is None:
+            continue
+        line_tests = contexts.line_tests(script)
+        hit = [(line_number, test_ids) for line_number, test_ids in line_tests
+               if changed is None or line_number in changed]
+        for line_number, test_ids in hit or line_tests:
+            for test_id in test_ids:
+                test_changes[os.path.abspath(contexts.tests[test_id])].add(
+                    (script, line_number))
+
+    selected = []
+    covered = set()
+    remaining = {}
+    for test in test_scripts:
+        key = os.path.abspath(test)
+        if key not in test_changes or key in changes:
+            selected.append(test)
+            covered.update(test_changes.get(key, ()))
+        elif test_changes[key]:
+            remaining[test] = test_changes[key]
+    while remaining:
+        # max keeps the first of equals
+        best = max(remaining, key=lambda test: len(remaining[test] - covered))
+        covered.update(remaining.pop(best))
+        selected.append(best)
+    return selected
+
+
+def display_who_covers(covered, tests_only: bool =False):
+    '''Print each line in covered with its tests, or with tests_only the tests.'''
+    if not tests_only:
+        for script, line_number, tests in covered:
+            print(f'{script}:{line_number} ' + ' '.join(tests))
+        return
+    seen = set()
+    for _, _, tests in covered:
+        for test in tests:
+            if test not in seen:
+                seen.add(test)
+                print(test)
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['combine']:
+        args = parse_combine_args(sys.argv[2:])
+        script_lines = combine_data_files(args.data_file, args.data_files, args.append)
+        print(f'Combined {len(args.data_files)} data files into {args.data_file} ({len(script_lines)} scripts)')
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['snapshot']:
+        args = parse_snapshot_args(sys.argv[2:])
+        with (nullcontext(sys.stdout) if args.output is None else open(args.output, 'w')) as report:
+            report.write(request_snapshot(args.socket, args.format))
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['who-covers']:
+        args = parse_who_covers_args(sys.argv[2:])
+        contexts = read_binary_contexts(args.data_file)
+        if not contexts:
+            print(f'{args.data_file} has no test contexts, record them with --contexts', file=sys.stderr)
+            sys.exit(1)
+        covered = iter_who_covers(contexts, args.locations or None)
+        if args.format == 'json' and not args.tests_only:
+            report = {}
+            for script, line_number, tests in covered:
+                report.setdefault(script, {})[str(line_number)] = tests
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            display_who_covers(covered, args.tests_only)
+        sys.exit(0)
+
+    if sys.argv[1:2] == ['collect']:
+        args = parse_collect_args(sys.argv[2:])
+        collector = CoverageCollector(args.only_paths, args.ignore_paths, args.replace_paths, args.engine, args.cache_dir)
+        if args.append and args.data_file is not None and os.path.exists(args.data_file):
+            collector.merge(read_binary_trace(args.data_file))
+        stop = start_collector(collector, args.socket, args.fifo)
+
+        def save(*_):
+            if args.data_file is not None:
+                update_data_file(args.data_file, collector.snapshot())
+
+        def finish(*_):
+            stop()
+            save()
+            sys.exit(0)
+        signal.signal(signal.SIGUSR1, save)
+        signal.signal(signal.SIGTERM, finish)
+        signal.signal(signal.SIGINT, finish)
+        while True:
+            signal.pause()
+
     args = parse_args(sys.argv[1:])
+    profile = None if args.profile is None else {}
+    contexts = TestContexts() if args.contexts else None
+    changes = None
+    if args.diff is not None or args.changed is not None:
+        changes = get_changes(args.diff, args.changed)
     if args.test_paths is not None:
+        # Found once here, the runners are given the test scripts themselves
+        test_scripts = [str(s) for s in find_test_scripts(args.test_paths, args.test_patterns, args.test_ignore, args.test_index)]
+        args.test_paths = test_scripts
+    if args.select:
+        data_file = args.data_file or DEFAULT_DATA_FILE
+        saved_contexts = read_binary_contexts(data_file) if os.path.exists(data_file) else TestContexts()
+        if saved_contexts:
+            args.test_paths = select_tests(test_scripts, saved_contexts, changes)
+            print(f'Selected {len(args.test_paths)} of {len(test_scripts)} test scripts', file=sys.stderr)
+        else:
+            print(f'**** {data_file} has no test contexts, running every test script', file=sys.stderr)
+    failed = []
+    if args.test_paths is not None and args.runner == 'asyncio':
+        script_lines, failed = run_test_scripts_async(args.test_paths, args.only_paths, args.ignore_paths, args.replace_paths, args.jobs, args.timeout, args.xtrace_fd, profile, args.fail_fast, contexts)
+    elif args.test_paths is not None:
         # We need to run the test scripts to collect results
-        script_lines = run_test_scripts(args.test_paths, args.only_paths, args.ignore_paths, args.replace_paths)
+        script_lines = run_test_scripts(args.test_paths, args.only_paths, args.ignore_paths, args.replace_paths, args.jobs, args.timeout, args.xtrace_fd, profile, contexts)
     else:
         # Canned results must have been provided
-        script_lines = get_script_lines_from_canned_results(args.canned_results, args.only_paths, args.ignore_paths, args.replace_paths)
-
-    lines_to_cover = get_lines_in_scripts([s for s in script_lines])
-    display_results(lines_to_cover, script_lines)
+        script_lines = get_script_lines_from_canned_results(args.canned_results, args.only_paths, args.ignore_paths, args.replace_paths, args.jobs, profile)
+
+    if args.record is not None:
+        write_binary_trace(args.record, script_lines, contexts)
+    if args.data_file is not None or args.append:
+        # Report on everything in the data file, not just this run
+        script_lines = update_data_file(args.data_file or DEFAULT_DATA_FILE, script_lines, args.append, contexts)
+
+    if changes is not None:
+        # Only changed scripts go through the strip pipeline
+        script_lines = restrict_to_changes(script_lines, changes)
+
+    # Scripts are only analysed as the report reaches them
+    lines_to_cover = iter_lines_in_scripts([s for s in script_lines], args.cache_dir, args.cache_size * 1024 * 1024, args.engine, args.jobs)
+    if changes is not None:
+        lines_to_cover = iter_changed_lines(lines_to_cover, changes)
+    if args.fail_under is not None and not args.summary_only:
+        # The totals are needed after the report
+        lines_to_cover = dict(lines_to_cover)
+    with (nullcontext(sys.stdout) if args.output is None else open(args.output, 'w')) as report:
+        if args.summary_only:
+            totals = summarise_coverage(lines_to_cover, script_lines, args.fail_under)
+            if args.format == 'json':
+                write_json_summary(*totals[:3], len(script_lines), report)
+            else:
+                display_summary(*totals[:3], len(script_lines), report)
+            # Stop any analysis still queued
+            lines_to_cover.close()
+        else:
+            write_report(args.format, lines_to_cover, script_lines, report)
+    if profile is not None:
+        # Kept off stdout so a json, cobertura or lcov report stays parseable
+        display_profile(profile, args.profile, sys.stderr)
+    if failed:
+        print(f'**** {len(failed)} test scripts failed: ' + ', '.join(failed), file=sys.stderr)
+        if args.fail_fast:
+            sys.exit(1)
+    if args.fail_under is not None:
+        if not args.summary_only:
+            totals = summarise_coverage(lines_to_cover, script_lines, args.fail_under)
+        if not totals[3]:
+            print(f'Total coverage is below --fail-under {args.fail_under:g}%', file=sys.stderr)
+            sys.exit(FAIL_UNDER_EXIT)
@@ -0,0 +1,161 @@
+'''Benchmarks for the script parsing and trace ingestion hot paths.
+
+Run with ``python -m test.benchmark``. Large shell scripts and PS4 traces
+are generated in a temporary directory, each hot path is timed, and one JSON
+record per benchmark is written (to stdout or --output) so results can be
+compared between versions. Use --trace-mb to generate multi-GB traces.
+'''
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import shell_cov.shell_cov as shell_cov
+
+BLOCK = r'''# block {i}
+echo "start {i}" \
+    --flag \
+    --other
+cat <<EOF
+heredoc {i}
+body
+EOF
+function func_{i} {{
+    local x="multi
+line {i}"
+    if [[ $x == y ]]; then
+        echo 'one' | \
+            grep o
+    fi
+}}
+func2_{i}() {{
+    case "$1" in
+        a) echo a ;;
+        *) :;;
+    esac
+}}
+for v in 1 2 3; do
+    echo "$v"
+done
+'''
+
+STRIP_PASSES = ('shell_strip_escaped_quotes', 'shell_strip_comments',
+                'shell_strip_xtrace', 'shell_strip_line_continuation',
+                'shell_strip_heredoc', 'shell_strip_function',
+                'shell_strip_multiline_quotes', 'shell_strip_logic')
+
+
+def generate_script(blocks):
+    '''Return a script made of blocks copies of BLOCK.'''
+    return ''.join(BLOCK.format(i=i) for i in range(blocks))
+
+
+def write_trace(path, scripts, size):
+    '''Write at least size bytes of PS4 trace lines for scripts to path.
+
+    The trace is written in chunks so it can be far larger than memory.
+    Every 10th line is ordinary stderr output which has to be skipped.
+    Returns the number of bytes and lines written.
+    '''
+    lines = []
+    for i in range(1000):
+        script = scripts[i % len(scripts)]
+        if i % 10 == 9:
+            lines.append('some error output from the test\n')
+        else:
+            lines.append(f'++PS4 + {script} + {i // 100}S + L{i % 300 + 1} '
+                         f'+ echo line {i}\n')
+    chunk = ''.join(lines).encode('utf-8')
+    written = 0
+    line_count = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            f.write(chunk)
+            written += len(chunk)
+            line_count += len(lines)
+    return written, line_count
+
+
+def timed(name, func, size, unit, repeat=1):
+    '''Time func, returning the best of repeat runs as a result record.'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {'name': name, 'seconds': round(best, 6), 'size': size,
+            'unit': unit, 'per_second': round(size / best, 1) if best else None}
+
+
+def run(tmp, blocks=400, scripts=20, trace_mb=50, report_scripts=10000,
+        repeat=3):
+    '''Run every benchmark in the directory tmp, returning the records.'''
+    results = []
+    text = generate_script(blocks)
+    line_count = text.count('\n')
+    data = '\n'.join(l.strip() for l in text.splitlines())
+    for name in STRIP_PASSES:
+        func = getattr(shell_cov, name)
+        results.append(timed(name, lambda: func(data), line_count, 'lines',
+                             repeat))
+
+    paths = []
+    for i in range(scripts):
+        paths.append(os.path.join(tmp, f'script_{i}.sh'))
+        with open(paths[-1], 'w') as f:
+            f.write(text)
+    for engine in shell_cov.ENGINES:
+        results.append(timed(
+            f'get_lines_in_scripts[{engine}]',
+            lambda: shell_cov.get_lines_in_scripts(paths, engine=engine),
+            line_count * scripts, 'lines', repeat))
+
+    trace = os.path.join(tmp, 'trace.txt')
+    size, trace_lines = write_trace(trace, paths, trace_mb * 1024 * 1024)
+    results.append(timed(
+        'get_executed_lines',
+        lambda: shell_cov.get_script_lines_from_canned_results([trace]),
+        trace_lines, 'trace lines'))
+    results[-1]['bytes'] = size
+
+    actual = {f'/path/to/script_{i}.sh': set(range(1, 200))
+              for i in range(report_scripts)}
+    seen = {s: set(range(1, 200, 3)) for s in actual}
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        results.append(timed('display_results',
+                             lambda: shell_cov.display_results(actual, seen),
+                             report_scripts, 'scripts', repeat))
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--blocks', type=int, default=400, help='Blocks of heredocs, functions, continuations and multi-line quotes in each generated script. Default: %(default)s')
+    parser.add_argument('--scripts', type=int, default=20, help='Number of generated scripts to analyse. Default: %(default)s')
+    parser.add_argument('--trace-mb', type=int, default=50, help='Size of the generated trace in MiB. Default: %(default)s')
+    parser.add_argument('--report-scripts', type=int, default=10000, help='Number of scripts in the generated report. Default: %(default)s')
+    parser.add_argument('--repeat', type=int, default=3, help='Take the best of this many runs of the quicker benchmarks. Default: %(default)s')
+    parser.add_argument('--output', help='Append the JSON records to this file rather than writing to stdout.')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(tmp, args.blocks, args.scripts, args.trace_mb,
+                      args.report_scripts, args.repeat)
+
+    environment = {'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'shellcov': shell_cov.VERSION, 'time': time.time()}
+    with (open(args.output, 'a') if args.output
+          else contextlib.nullcontext(sys.stdout)) as out:
+        for result in results:
+            out.write(json.dumps(dict(result, **environment)) + '\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,17 @@
+import tempfile
+import unittest
+
+from . import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_small(self):
+        # Keep the benchmark suite runnable, the timings don't matter here
+        with tempfile.TemporaryDirectory() as tmp:
+            results = benchmark.run(tmp, blocks=2, scripts=2, trace_mb=0,
+                                    report_scripts=2, repeat=1)
+        names = [r['name'] for r in results]
+        self.assertEqual(names[:len(benchmark.STRIP_PASSES)],
+                         list(benchmark.STRIP_PASSES))
+        self.assertIn('get_executed_lines', names)
+        self.assertIn('display_results', names)
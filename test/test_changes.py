@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import shell_cov.shell_cov as shell_cov
+
+DIFF = '''diff --git a/lib.sh b/lib.sh
+--- a/lib.sh
++++ b/lib.sh
+@@ -1,4 +1,6 @@
+ echo 1
+-echo 2
++echo two
+ echo 3
++++ not a header
+ echo 4
++echo 5
+\\ No newline at end of file
+diff --git a/gone.sh b/gone.sh
+--- a/gone.sh
++++ /dev/null
+@@ -1 +0,0 @@
+-echo gone
+diff --git a/new.sh b/new.sh
+--- /dev/null
++++ b/new.sh
+@@ -0,0 +1 @@
++echo new
+'''
+
+
+class TestChanges(unittest.TestCase):
+    def test_parse_unified_diff(self):
+        self.assertEqual(shell_cov.parse_unified_diff(DIFF.splitlines(True)),
+                         {'lib.sh': {2, 4, 6}, 'new.sh': {1}})
+
+    def test_restrict_to_changes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            diff = os.path.join(tmp, 'changes.diff')
+            with open(diff, 'w') as f:
+                f.write(DIFF)
+            untraced = os.path.join(tmp, 'untraced.sh')
+            open(untraced, 'w').close()
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                changes = shell_cov.get_changes(diff, ['whole.sh',
+                                                       'untraced.sh'])
+                restricted = shell_cov.restrict_to_changes(
+                    {'lib.sh': {1, 2, 6}, os.path.join(tmp, 'whole.sh'): {3},
+                     'other.sh': {1}}, changes)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual(restricted, {'lib.sh': {2, 6},
+                                      os.path.join(tmp, 'whole.sh'): {3},
+                                      untraced: set()})
@@ -0,0 +1,74 @@
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import shell_cov.shell_cov as shell_cov
+
+
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.script = os.path.join(tmp.name, 'lib.sh')
+        with open(self.script, 'w') as f:
+            f.write('echo a\necho b\necho c\n')
+        self.socket = os.path.join(tmp.name, 'sock')
+        self.fifo = os.path.join(tmp.name, 'fifo')
+        self.collector = shell_cov.CoverageCollector(path_ignore=['/other'])
+        stop = shell_cov.start_collector(self.collector, self.socket,
+                                         self.fifo)
+        self.addCleanup(stop)
+
+    def record(self, line_number, script=None):
+        return (f'+PS4 + {script or self.script} + 0S + L{line_number} + x\n'
+                .encode())
+
+    def wait_for(self, expected):
+        for _ in range(100):
+            if self.collector.snapshot() == expected:
+                return
+            time.sleep(0.02)
+        self.assertEqual(self.collector.snapshot(), expected)
+
+    def test_collects_from_socket_and_fifo(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket)
+            client.sendall(self.record(1) + self.record(1, '/other.sh'))
+            self.wait_for({self.script: {1}})
+            with open(self.fifo, 'wb') as fifo:
+                fifo.write(self.record(3))
+            self.wait_for({self.script: {1, 3}})
+
+        report = json.loads(shell_cov.request_snapshot(self.socket, 'json'))
+        self.assertEqual(report['files'][self.script]['missing_lines'], [2])
+
+    def test_merge_and_unknown_format(self):
+        self.collector.merge({self.script: {2}})
+        self.assertEqual(self.collector.snapshot(), {self.script: {2}})
+        self.assertIn('Unknown report format',
+                      shell_cov.request_snapshot(self.socket, 'bogus'))
+
+    def test_concurrent_text_snapshots(self):
+        cache_dir = os.path.join(os.path.dirname(self.socket), 'cache')
+        collector = shell_cov.CoverageCollector(cache_dir=cache_dir)
+        scripts = []
+        for i in range(50):
+            scripts.append(os.path.join(cache_dir + '_scripts', f'{i}.sh'))
+            os.makedirs(os.path.dirname(scripts[-1]), exist_ok=True)
+            with open(scripts[-1], 'w') as f:
+                f.write(f'echo {i}\necho\n')
+        collector.merge({script: {1} for script in scripts})
+        sock = self.socket + '2'
+        self.addCleanup(shell_cov.start_collector(collector, sock))
+        stdout = sys.stdout
+        with ThreadPoolExecutor(8) as pool:
+            reports = list(pool.map(
+                lambda _: shell_cov.request_snapshot(sock, 'text'), range(8)))
+        self.assertIs(sys.stdout, stdout)
+        self.assertEqual(len(set(reports)), 1)
+        self.assertEqual(reports[0].count('50%'), 50)
@@ -0,0 +1,131 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import shell_cov.shell_cov as shell_cov
+
+
+class TestContexts(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.data_file = os.path.join(self.tmp, '.shellcov')
+        self.contexts = shell_cov.TestContexts()
+        self.contexts.add('test_a.sh', {'/lib.sh': {1, 2}})
+        self.contexts.add('test_b.sh', {'/lib.sh': {2, 3}, '/b.sh': {1}})
+
+    def test_queries(self):
+        self.assertEqual(self.contexts.who_covers('/lib.sh', 2),
+                         ['test_a.sh', 'test_b.sh'])
+        self.assertEqual(self.contexts.who_covers('/lib.sh', 9), [])
+        self.assertEqual(self.contexts.covering_tests('/lib.sh', {1}),
+                         ['test_a.sh'])
+        self.assertEqual(self.contexts.covering_tests('/b.sh'), ['test_b.sh'])
+
+    def test_merge_replaces_tests_run_again(self):
+        other = shell_cov.TestContexts()
+        other.add('test_c.sh', {'/lib.sh': {1}})
+        other.add('test_a.sh', {'/lib.sh': {3}})
+        self.contexts.merge(other)
+        self.assertEqual(self.contexts.tests,
+                         ['test_a.sh', 'test_b.sh', 'test_c.sh'])
+        self.assertEqual(self.contexts.who_covers('/lib.sh', 1), ['test_c.sh'])
+        self.assertEqual(self.contexts.who_covers('/lib.sh', 3),
+                         ['test_a.sh', 'test_b.sh'])
+
+    def test_discard_several_tests(self):
+        self.contexts.discard('test_a.sh', 'test_b.sh', 'test_x.sh')
+        self.assertEqual(self.contexts.covering_tests('/lib.sh'), [])
+        self.contexts.add('test_b.sh', {'/lib.sh': {2}})
+        self.assertEqual(self.contexts.who_covers('/lib.sh', 2), ['test_b.sh'])
+
+    def test_binary_round_trip(self):
+        script_lines = {'/lib.sh': {1, 2, 3}, '/b.sh': {1}}
+        shell_cov.write_binary_trace(self.data_file, script_lines,
+                                     self.contexts)
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file),
+                         script_lines)
+        contexts = shell_cov.read_binary_contexts(self.data_file)
+        self.assertEqual(list(shell_cov.iter_who_covers(contexts)),
+                         list(shell_cov.iter_who_covers(self.contexts)))
+        shell_cov.write_binary_trace(self.data_file, script_lines)
+        self.assertEqual(len(shell_cov.read_binary_contexts(self.data_file)), 0)
+
+    def test_append_keeps_saved_contexts(self):
+        shell_cov.update_data_file(self.data_file, {'/lib.sh': {1, 2, 3}},
+                                   contexts=self.contexts)
+        shell_cov.update_data_file(self.data_file, {'/lib.sh': {4}},
+                                   append=True)
+        again = shell_cov.TestContexts()
+        again.add('test_b.sh', {'/lib.sh': {4}})
+        shell_cov.update_data_file(self.data_file, {'/lib.sh': {4}},
+                                   append=True, contexts=again)
+        contexts = shell_cov.read_binary_contexts(self.data_file)
+        self.assertEqual(contexts.covering_tests('/lib.sh', {2}),
+                         ['test_a.sh'])
+        self.assertEqual(contexts.who_covers('/lib.sh', 4), ['test_b.sh'])
+
+    def test_iter_who_covers_locations(self):
+        self.assertEqual(
+            list(shell_cov.iter_who_covers(self.contexts,
+                                           ['/lib.sh:3', '/b.sh', '/x.sh'])),
+            [('/lib.sh', 3, ['test_b.sh']), ('/b.sh', 1, ['test_b.sh'])])
+
+    def test_who_covers_command(self):
+        shell_cov.write_binary_trace(self.data_file, {}, self.contexts)
+        command = [sys.executable, '-m', 'shell_cov.shell_cov', 'who-covers',
+                   '--data-file', self.data_file]
+        run = subprocess.run(command + ['/lib.sh'], check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(run.stdout.splitlines(),
+                         ['/lib.sh:1 test_a.sh',
+                          '/lib.sh:2 test_a.sh test_b.sh',
+                          '/lib.sh:3 test_b.sh'])
+        run = subprocess.run(command + ['--tests-only', '/lib.sh:2', '/b.sh'],
+                             check=True, stdout=subprocess.PIPE,
+                             universal_newlines=True)
+        self.assertEqual(run.stdout.splitlines(), ['test_a.sh', 'test_b.sh'])
+        run = subprocess.run(command + ['--format', 'json', '/b.sh'],
+                             check=True, stdout=subprocess.PIPE)
+        self.assertEqual(json.loads(run.stdout), {'/b.sh': {'1': ['test_b.sh']}})
+
+
+class TestSelectTests(unittest.TestCase):
+    def setUp(self):
+        self.contexts = shell_cov.TestContexts()
+        self.contexts.add('/t/test_a.sh', {'/lib.sh': {1, 2}})
+        self.contexts.add('/t/test_b.sh', {'/lib.sh': {2, 3, 4}})
+        self.contexts.add('/t/test_c.sh', {'/lib.sh': {4}, '/other.sh': {1}})
+        self.tests = ['/t/test_a.sh', '/t/test_b.sh', '/t/test_c.sh']
+
+    def select(self, changes, tests=None):
+        return shell_cov.select_tests(tests or self.tests, self.contexts,
+                                      changes)
+
+    def test_only_tests_covering_changed_lines(self):
+        self.assertEqual(self.select({'/lib.sh': shell_cov.LineSet({1})}),
+                         ['/t/test_a.sh'])
+        self.assertEqual(self.select({'/other.sh': None}), ['/t/test_c.sh'])
+        self.assertEqual(self.select({'/unused.sh': None}), [])
+
+    def test_most_changed_lines_first(self):
+        self.assertEqual(
+            self.select({'/lib.sh': shell_cov.LineSet({1, 3})}),
+            ['/t/test_a.sh', '/t/test_b.sh'])
+        # test_c adds nothing after test_b, but still ran a changed line
+        self.assertEqual(self.select({'/lib.sh': None}),
+                         ['/t/test_b.sh', '/t/test_a.sh', '/t/test_c.sh'])
+
+    def test_uncovered_changed_lines_select_every_test_of_the_script(self):
+        self.assertEqual(self.select({'/other.sh': shell_cov.LineSet({7})}),
+                         ['/t/test_c.sh'])
+
+    def test_changed_and_new_tests_run_first(self):
+        tests = self.tests + ['/t/test_new.sh']
+        self.assertEqual(
+            self.select({'/other.sh': None, '/t/test_b.sh': None}, tests),
+            ['/t/test_b.sh', '/t/test_new.sh', '/t/test_c.sh'])
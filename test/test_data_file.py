@@ -0,0 +1,66 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import shell_cov.shell_cov as shell_cov
+
+
+class TestDataFile(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+        self.data_file = os.path.join(self.tmp, '.shellcov')
+
+    def test_update_replaces_or_appends(self):
+        shell_cov.update_data_file(self.data_file, {'/a.sh': {1}})
+        shell_cov.update_data_file(self.data_file, {'/a.sh': {2}})
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file),
+                         {'/a.sh': {2}})
+        merged = shell_cov.update_data_file(
+            self.data_file, {'/a.sh': {3}, '/b.sh': {4}}, append=True)
+        self.assertEqual(merged, {'/a.sh': {2, 3}, '/b.sh': {4}})
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file), merged)
+        self.assertEqual(os.listdir(self.tmp), ['.shellcov'])
+
+    def test_failed_write_keeps_old_file(self):
+        shell_cov.update_data_file(self.data_file, {'/a.sh': {1}})
+
+        def fail(path, *args):
+            open(path, 'wb').close()
+            raise OSError('disk full')
+        with mock.patch.object(shell_cov, 'write_binary_trace', fail):
+            with self.assertRaises(OSError):
+                shell_cov.update_data_file(self.data_file, {'/a.sh': {2}})
+        self.assertEqual(os.listdir(self.tmp), ['.shellcov'])
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file),
+                         {'/a.sh': {1}})
+
+    def test_append_creates_missing_file(self):
+        shell_cov.update_data_file(self.data_file, {'/a.sh': {1}}, append=True)
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file),
+                         {'/a.sh': {1}})
+
+    def test_combine_command(self):
+        shards = []
+        for i in range(3):
+            shards.append(os.path.join(self.tmp, f'shard{i}'))
+            shell_cov.write_binary_trace(shards[-1], {'/a.sh': {i},
+                                                      f'/{i}.sh': {1}})
+        subprocess.run([sys.executable, '-m', 'shell_cov.shell_cov',
+                        'combine', '--data-file', self.data_file] + shards,
+                       check=True, stdout=subprocess.DEVNULL)
+        self.assertEqual(shell_cov.read_binary_trace(self.data_file),
+                         {'/a.sh': {0, 1, 2}, '/0.sh': {1}, '/1.sh': {1},
+                          '/2.sh': {1}})
+
+    def test_append_option(self):
+        args = shell_cov.parse_args(['-r', 'trace', '--append'])
+        self.assertTrue(args.append)
+        self.assertIsNone(args.data_file)
+        args = shell_cov.parse_combine_args(['a', 'b'])
+        self.assertEqual(args.data_file, shell_cov.DEFAULT_DATA_FILE)
+        self.assertEqual(args.data_files, ['a', 'b'])
@@ -0,0 +1,120 @@
+import unittest
+
+import shell_cov.shell_cov as shell_cov
+
+from .test_regex_removal import RAW_TEXT
+
+# Lines marked with '*' are the ones bash reports executing, apart from
+# multi-line commands which by convention count on their last line
+SCRIPT = r'''
+*arg=1
+*case "$arg" in
+*  1) echo one
+     ;;
+   2)
+*     echo two ;;
+ esac
+*case "$arg"
+ in
+*  1) : ;;
+ esac
+*if [[ $arg == 1 ]]
+ then
+*  echo yes
+ else
+*  echo no
+ fi
+*for i in 1 2
+ do
+*  echo $i
+ done
+*while false; do :; done
+ f() {
+*  echo in f
+ }
+ function g {
+*  echo in g
+ }
+*f; g # comment ; echo
+ echo "multi
+*line"
+*cat <<EOF
+ body
+ EOF
+ cat <<- 'EOF'; echo $(( 1 +
+*	2 ))
+ 	body
+ 	EOF
+ x=$(
+*echo sub
+*)
+*{ echo grp; }
+ (
+*echo sub2
+ ) >/dev/null 2>&1
+*true &&
+*  echo after
+ arr=(
+  a
+*)
+ [[ 1 == 1 &&
+*   2 == 2 ]]
+ echo ${x:-
+*}
+ echo 'x' \
+*  y
+*set -o pipefail
+ set -eux
+*echo ok; set -x
+*for ((i=0; i<1; i++)); do
+*  :
+ done
+*h() { echo h; }
+'''
+
+
+class TestLexer(unittest.TestCase):
+    def test_shell_lexer_lines(self):
+        text = '\n'.join(line[1:] for line in SCRIPT.splitlines())
+        expected = {i for i, line in enumerate(SCRIPT.splitlines(), 1)
+                    if line.startswith('*')}
+        self.assertEqual(shell_cov.shell_lexer_lines(text), expected)
+
+    def test_agrees_with_regex_on_functions(self):
+        text = '\n'.join(RAW_TEXT.splitlines()[64:])
+        self.assertEqual(shell_cov.get_lines_in_script(text, 'lexer'),
+                         shell_cov.get_lines_in_script(text, 'regex'))
+
+    def test_unbalanced_test_does_not_swallow_script(self):
+        self.assertEqual(shell_cov.shell_lexer_lines('[[ 1 == 1]]; then\n:\n'),
+                         {1, 2})
+
+    def test_lex_shell_tokens(self):
+        self.assertEqual(
+            list(shell_cov._lex_shell('a "b\nc"|d $(e)\n')),
+            [('word', 'a', 1), ('word', '"b\nc"', 2), ('op', '|', 2),
+             ('word', 'd', 2), ('word', '$', 2), ('push', '$(', 2),
+             ('word', 'e', 2), ('pop', ')', 2), ('newline', '\n', 2),
+             ('newline', '', 3)])
+
+    def test_shell_function_spans(self):
+        text = '\n'.join([
+            'foo() {',
+            '  echo "}"',
+            '  bar () (',
+            '    echo ")"',
+            '  )',
+            '}',
+            'function baz',
+            '{',
+            '  cat <<EOF',
+            '}',
+            'EOF',
+            '}',
+            'function qux() { echo y; }',
+            'echo foo() ok',
+            'x=$(f() { :; }; f)',
+        ])
+        self.assertEqual(shell_cov.shell_function_spans(text),
+                         [('bar', 3, 5), ('foo', 1, 6), ('baz', 7, 12),
+                          ('qux', 13, 13), ('f', 15, 15)])
@@ -0,0 +1,52 @@
+import pickle
+import unittest
+
+import shell_cov.shell_cov as shell_cov
+
+
+class TestLineSet(unittest.TestCase):
+    def test_set_api(self):
+        lines = shell_cov.LineSet([5, 1, 300, 1])
+        self.assertEqual(list(lines), [1, 5, 300])
+        self.assertEqual(len(lines), 3)
+        self.assertIn(300, lines)
+        self.assertNotIn(2, lines)
+        self.assertNotIn(-1, lines)
+        lines.add(2)
+        lines.discard(5)
+        lines.update({7}, shell_cov.LineSet([8]))
+        self.assertEqual(lines, {1, 2, 7, 8, 300})
+        lines.difference_update({7}, shell_cov.LineSet([300, 9]))
+        self.assertEqual(lines, {1, 2, 8})
+        self.assertFalse(shell_cov.LineSet())
+        self.assertEqual(repr(shell_cov.LineSet([3])), 'LineSet({3})')
+
+    def test_operations_accept_plain_sets(self):
+        lines = shell_cov.LineSet([1, 2, 3])
+        self.assertEqual(lines - {2}, {1, 3})
+        self.assertEqual({2, 4} - lines, {4})
+        self.assertEqual(lines | {9}, {1, 2, 3, 9})
+        self.assertEqual({9} | lines, {1, 2, 3, 9})
+        self.assertEqual(lines & {3, 4}, {3})
+        self.assertEqual(lines.difference(shell_cov.LineSet([1])), {2, 3})
+        self.assertTrue(shell_cov.LineSet([1]).issubset({1, 2}))
+        self.assertIsInstance(lines - {2}, shell_cov.LineSet)
+        self.assertEqual({1, 2, 3}, lines)
+        self.assertNotEqual(lines, {1, 2})
+        self.assertNotEqual(lines, [1, 2, 3])
+
+    def test_negative_lines_are_rejected(self):
+        with self.assertRaises(ValueError):
+            shell_cov.LineSet([-1])
+
+    def test_pickles(self):
+        lines = shell_cov.LineSet(range(0, 10000, 3))
+        self.assertEqual(pickle.loads(pickle.dumps(lines)), lines)
+
+    def test_line_info_accepts_either(self):
+        for make in (set, shell_cov.LineSet):
+            values, problems = shell_cov.get_line_info(
+                {'a.sh': make({1, 2, 3, 4})}, {'a.sh': make({1, 2, 9})})
+            self.assertEqual(values[1], ['a.sh', '4', '2', '50%', '3-4'])
+            self.assertEqual(problems['a.sh'], {9})
+
@@ -0,0 +1,140 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import shell_cov.shell_cov as shell_cov
+
+from .test_regex_removal import RAW_TEXT
+
+
+class TestLinesInScripts(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache_dir = os.path.join(self.tmp.name, 'cache')
+        self.scripts = []
+        for name, text in (('raw.sh', RAW_TEXT), ('small.sh', 'a\n\nb\n')):
+            self.scripts.append(os.path.join(self.tmp.name, name))
+            with open(self.scripts[-1], 'w') as f:
+                f.write(text)
+
+    def test_get_lines_in_scripts(self):
+        result = shell_cov.get_lines_in_scripts(self.scripts)
+        self.assertEqual(result[self.scripts[0]],
+                         shell_cov.get_lines_in_script(RAW_TEXT))
+        self.assertEqual(result[self.scripts[1]], {1, 3})
+
+    def test_cache_skips_unchanged_scripts(self):
+        expected = shell_cov.get_lines_in_scripts(self.scripts)
+        self.assertEqual(
+            shell_cov.get_lines_in_scripts(self.scripts, self.cache_dir),
+            expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        with open(self.scripts[1], 'w') as f:
+            f.write('a\nb\n')
+        with mock.patch.object(shell_cov, 'get_lines_in_script',
+                               wraps=shell_cov.get_lines_in_script) as parse:
+            result = shell_cov.get_lines_in_scripts(self.scripts,
+                                                    self.cache_dir)
+        parse.assert_called_once_with('a\nb\n', 'regex')
+        self.assertEqual(result[self.scripts[0]], expected[self.scripts[0]])
+        self.assertEqual(result[self.scripts[1]], {1, 2})
+
+    def test_cache_is_size_bounded(self):
+        shell_cov.get_lines_in_scripts(self.scripts, self.cache_dir)
+        for entry in os.listdir(self.cache_dir):
+            os.utime(os.path.join(self.cache_dir, entry), (0, 0))
+        small_entry = shell_cov._cache_entry_path(self.cache_dir, b'a\nb\n')
+        with open(self.scripts[1], 'w') as f:
+            f.write('a\nb\n')
+        # Room for only the newest, smallest entry
+        shell_cov.get_lines_in_scripts(self.scripts[1:], self.cache_dir,
+                                       cache_size=8)
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(small_entry)])
+
+    def test_bad_entries_are_cache_misses(self):
+        expected = shell_cov.get_lines_in_scripts(self.scripts)
+        shell_cov.get_lines_in_scripts(self.scripts, self.cache_dir)
+        # A truncated entry, as left by a crash
+        with open(shell_cov._cache_entry_path(self.cache_dir,
+                                              b'a\n\nb\n'), 'ab') as f:
+            f.write(b'\0')
+        # Entries evicted by another run before they are touched
+        with mock.patch('os.utime', side_effect=FileNotFoundError):
+            self.assertEqual(
+                shell_cov.get_lines_in_scripts(self.scripts, self.cache_dir),
+                expected)
+
+    def test_read_only_cache_is_best_effort(self):
+        expected = shell_cov.get_lines_in_scripts(self.scripts)
+        shell_cov.get_lines_in_scripts(self.scripts[:1], self.cache_dir)
+        real_open = open
+
+        def read_only_open(path, mode='r', *args, **kwargs):
+            if 'w' in mode and str(path).startswith(self.cache_dir):
+                raise PermissionError(path)
+            return real_open(path, mode, *args, **kwargs)
+        with mock.patch('builtins.open', read_only_open), \
+                mock.patch('os.remove', side_effect=PermissionError):
+            self.assertEqual(
+                shell_cov.get_lines_in_scripts(self.scripts, self.cache_dir,
+                                               cache_size=0),
+                expected)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_parser_revision_is_part_of_the_key(self):
+        entry = shell_cov._cache_entry_path(self.cache_dir, b'a')
+        with mock.patch.object(shell_cov, 'PARSER_REVISION',
+                               shell_cov.PARSER_REVISION + 1):
+            self.assertNotEqual(
+                shell_cov._cache_entry_path(self.cache_dir, b'a'), entry)
+
+    def test_parallel_matches_serial(self):
+        for i in range(10):
+            self.scripts.append(os.path.join(self.tmp.name, f'{i}.sh'))
+            with open(self.scripts[-1], 'w') as f:
+                f.write('echo\n' * i)
+        serial = shell_cov.get_lines_in_scripts(self.scripts)
+        for engine in shell_cov.ENGINES:
+            parallel = shell_cov.get_lines_in_scripts(
+                self.scripts, self.cache_dir, engine=engine, jobs=3)
+            self.assertEqual(list(parallel), self.scripts)
+            if engine == 'regex':
+                self.assertEqual(parallel, serial)
+
+    def test_lazy_analysis_stops_early(self):
+        with mock.patch.object(shell_cov, 'get_lines_in_script',
+                               wraps=shell_cov.get_lines_in_script) as parse:
+            lazy = shell_cov.iter_lines_in_scripts(self.scripts,
+                                                   self.cache_dir)
+            self.assertEqual(parse.call_count, 0)
+            self.assertEqual(next(lazy)[0], self.scripts[0])
+            lazy.close()
+        self.assertEqual(parse.call_count, 1)
+        # The cache is still trimmed when the caller stops early
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    def test_summary_fail_under_stops_early(self):
+        scripts = {}
+        for i in range(6):
+            scripts[os.path.join(self.tmp.name, f'{i}.sh')] = {1, 2}
+            with open(os.path.join(self.tmp.name, f'{i}.sh'), 'w') as f:
+                f.write('echo\n' * 4)
+        for jobs in (1, 2):
+            self.assertEqual(shell_cov.summarise_coverage(
+                shell_cov.iter_lines_in_scripts(scripts, jobs=jobs),
+                scripts), (24, 12, 6, None))
+            # Unread scripts could at most add 2 covered of 2 lines each
+            self.assertEqual(shell_cov.summarise_coverage(
+                shell_cov.iter_lines_in_scripts(scripts, jobs=jobs),
+                scripts, fail_under=60), (20, 10, 5, False))
+            # or add 4 uncovered lines each
+            self.assertEqual(shell_cov.summarise_coverage(
+                shell_cov.iter_lines_in_scripts(scripts, jobs=jobs),
+                scripts, fail_under=10), (8, 4, 2, True))
+            self.assertEqual(shell_cov.summarise_coverage(
+                shell_cov.get_lines_in_scripts(scripts), scripts,
+                fail_under=50), (24, 12, 6, True))
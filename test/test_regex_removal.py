@@ -125,3 +125,13 @@ class TestRegex(unittest.TestCase):
     def test_shell_strip_logic(self):
         self.assertEqual(shell_cov.shell_strip_logic(RAW_TEXT),
                          test_expected_results.LOGIC)
+
+    def test_shell_strip_function_replaces_match_in_place(self):
+        # The matched text also appears earlier in the script, which must be
+        # left alone
+        self.assertEqual(shell_cov.shell_strip_function('echo f() {\nf() {\n:\n}'),
+                         'echo f() {\n\n:\n}')
+
+    def test_shell_strip_heredoc_ends_at_first_terminator(self):
+        self.assertEqual(shell_cov.shell_strip_heredoc('cat <<EOF\nEOF\nEOF\nEOF'),
+                         'cat ' + shell_cov.FILLER + '\n\nEOF\nEOF')
@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+import xml.etree.ElementTree as ElementTree
+
+import shell_cov.shell_cov as shell_cov
+
+LINES_TO_COVER = {'/a/x&y.sh': {1, 2, 3, 4}, '/b/z.sh': {5}}
+SCRIPT_LINES = {'/a/x&y.sh': {1, 3, 9}, '/b/z.sh': set()}
+
+
+def report(writer):
+    f = io.StringIO()
+    writer(shell_cov.iter_coverage(LINES_TO_COVER, SCRIPT_LINES), f)
+    return f.getvalue()
+
+
+class TestReportWriters(unittest.TestCase):
+    def test_iter_coverage(self):
+        self.assertEqual(
+            list(shell_cov.iter_coverage(LINES_TO_COVER, SCRIPT_LINES))[0],
+            ('/a/x&y.sh', {1, 2, 3, 4}, {1, 3}, {2, 4}, {9}))
+
+    def test_json(self):
+        data = json.loads(report(shell_cov.write_json_report))
+        self.assertEqual(data['files']['/a/x&y.sh'], {
+            'executed_lines': [1, 3], 'missing_lines': [2, 4],
+            'unrecognised_lines': [9],
+            'summary': {'num_statements': 4, 'covered_lines': 2,
+                        'missing_lines': 2, 'percent_covered': 50.0}})
+        self.assertEqual(data['totals']['num_statements'], 5)
+        self.assertEqual(data['totals']['percent_covered'], 40.0)
+
+    def test_json_without_scripts(self):
+        f = io.StringIO()
+        shell_cov.write_json_report(iter(()), f)
+        self.assertEqual(json.loads(f.getvalue())['files'], {})
+
+    def test_cobertura(self):
+        root = ElementTree.fromstring(report(shell_cov.write_cobertura_report))
+        self.assertEqual((root.get('lines-valid'), root.get('lines-covered'),
+                          root.get('line-rate')), ('5', '2', '0.4'))
+        classes = root.findall('./packages/package/classes/class')
+        self.assertEqual([c.get('filename') for c in classes],
+                         ['/a/x&y.sh', '/b/z.sh'])
+        self.assertEqual([(line.get('number'), line.get('hits'))
+                          for line in classes[0].iter('line')],
+                         [('1', '1'), ('2', '0'), ('3', '1'), ('4', '0')])
+
+    def test_lcov(self):
+        self.assertEqual(report(shell_cov.write_lcov_report), (
+            'TN:\nSF:/a/x&y.sh\nDA:1,1\nDA:2,0\nDA:3,1\nDA:4,0\n'
+            'LF:4\nLH:2\nend_of_record\n'
+            'TN:\nSF:/b/z.sh\nDA:5,0\nLF:1\nLH:0\nend_of_record\n'))
+
+    def test_profile_keeps_machine_reports_parseable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            script = os.path.join(tmp, 'lib.sh')
+            trace = os.path.join(tmp, 'trace.txt')
+            with open(script, 'w') as f:
+                f.write('echo a\necho b\n')
+            with open(trace, 'w') as f:
+                f.write(f'+PS4 + {script} + 1.0S + L1 + echo a\n'
+                        f'+PS4 + {script} + 1.5S + L2 + echo b\n')
+            run = subprocess.run(
+                [sys.executable, '-m', 'shell_cov.shell_cov', '-r', trace,
+                 '--format', 'json', '--profile'],
+                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+        self.assertIn(script, json.loads(run.stdout)['files'])
+        self.assertIn('---- hottest lines ----', run.stderr)
+
+    def test_summary_only_formats(self):
+        f = io.StringIO()
+        shell_cov.write_json_summary(5, 2, 1, 2, f)
+        data = json.loads(f.getvalue())
+        self.assertEqual(data['totals'], shell_cov._json_summary(5, 2))
+        self.assertEqual((data['scripts_read'], data['scripts']), (1, 2))
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            shell_cov.parse_args(['-r', 'trace', '--summary-only',
+                                  '--format', 'lcov'])
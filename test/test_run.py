@@ -0,0 +1,248 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+import shell_cov.shell_cov as shell_cov
+
+# bash ignores PS4 from the environment when run as root, so the test
+# scripts set it themselves before turning on tracing
+SCRIPT = '''PS4='{ps4}'
+set -x
+echo {name}
+sleep 0.{delay}
+echo done
+'''
+
+
+class TestRunTestScripts(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        for i, name in enumerate(('c', 'a', 'b')):
+            with open(os.path.join(self.tmp.name, f'test_{name}.sh'),
+                      'w') as f:
+                f.write(SCRIPT.format(ps4=shell_cov.DEFAULT_PS4, name=name,
+                                      delay=3 - i))
+        for p in (mock.patch.object(shell_cov, 'BASE_CMD', ['/bin/bash']),
+                  mock.patch('sys.stdin', **{'isatty.return_value': True})):
+            p.start()
+            self.addCleanup(p.stop)
+
+    def expected(self):
+        return {os.path.join(self.tmp.name, f'test_{name}.sh'): {3, 4, 5}
+                for name in ('a', 'b', 'c')}
+
+    def test_find_scripts_sorted(self):
+        self.assertEqual([p.name for p in shell_cov.find_scripts(self.tmp.name)],
+                         ['test_a.sh', 'test_b.sh', 'test_c.sh'])
+
+    def test_find_scripts_patterns_and_ignore(self):
+        for name in ('skip/test_x.sh', 'sub/test_y.bash', 'sub/test_z.py',
+                     'sub/deeper/check_w.sh'):
+            path = os.path.join(self.tmp.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        os.makedirs(os.path.join(self.tmp.name, 'test_dir.sh'))
+        found = shell_cov.find_scripts(self.tmp.name, ignore=['skip'])
+        self.assertEqual([str(p.relative_to(self.tmp.name)) for p in found],
+                         ['sub/test_y.bash', 'test_a.sh', 'test_b.sh',
+                          'test_c.sh'])
+        found = shell_cov.find_scripts(self.tmp.name, ['check_*', '*.py'],
+                                       ['test_a.sh'])
+        self.assertEqual([str(p.relative_to(self.tmp.name)) for p in found],
+                         ['sub/deeper/check_w.sh', 'sub/test_z.py'])
+
+    def test_index_skips_unchanged_directories(self):
+        os.makedirs(os.path.join(self.tmp.name, 'sub'))
+        # Outside the tree, or saving it would change the tree's mtime
+        index_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(index_dir.cleanup)
+        index_file = os.path.join(index_dir.name, 'index.json')
+        for directory in (self.tmp.name, os.path.join(self.tmp.name, 'sub')):
+            os.utime(directory, (0, 0))
+        expected = shell_cov.find_test_scripts([self.tmp.name],
+                                               index_file=index_file)
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            self.assertEqual(shell_cov.find_test_scripts(
+                [self.tmp.name], index_file=index_file), expected)
+            self.assertEqual(scandir.call_count, 0)
+            # A new script changes the directory's mtime
+            path = os.path.join(self.tmp.name, 'sub', 'test_d.sh')
+            open(path, 'w').close()
+            self.assertEqual(shell_cov.find_test_scripts(
+                [self.tmp.name], index_file=index_file),
+                sorted(expected + [shell_cov.Path(path)]))
+            self.assertEqual(scandir.call_count, 1)
+        # Other patterns don't reuse the index
+        self.assertEqual(shell_cov.find_test_scripts(
+            [self.tmp.name], ['test_d.sh'], index_file=index_file),
+            [shell_cov.Path(path)])
+
+    def test_merge_script_lines(self):
+        merged = shell_cov.merge_script_lines({'a': {1}}, {'a': {2}, 'b': {3}})
+        self.assertEqual(merged, {'a': {1, 2}, 'b': {3}})
+
+    def test_run_test_scripts_serial(self):
+        result = shell_cov.run_test_scripts([self.tmp.name], jobs=1)
+        self.assertEqual(result, self.expected())
+        self.assertEqual(list(result), sorted(result))
+
+    def test_run_test_scripts_parallel_is_deterministic(self):
+        result = shell_cov.run_test_scripts([self.tmp.name], jobs=3)
+        self.assertEqual(result, self.expected())
+        # The slowest script is first, but the order still follows the tests
+        self.assertEqual(list(result), sorted(result))
+
+    def test_large_output_does_not_deadlock(self):
+        # Far more than a pipe buffer on both stdout and stderr
+        path = os.path.join(self.tmp.name, 'test_big.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    'for i in $(seq 2000); do\n'
+                    'printf "%0200d\\n" "$i"\n'
+                    'done\n')
+        result = shell_cov.run_test_scripts([path], jobs=1, timeout=60)
+        self.assertEqual(result, {path: {3, 4}})
+
+    def test_timeout_keeps_lines_traced_so_far(self):
+        path = os.path.join(self.tmp.name, 'test_hang.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    'echo started\n'
+                    'sleep 60\n'
+                    'echo never\n')
+        with mock.patch('sys.stderr') as stderr:
+            result = shell_cov.run_test_scripts([path], jobs=1, timeout=0.5)
+        self.assertEqual(result, {path: {3, 4}})
+        self.assertIn('timed out', str(stderr.write.call_args_list))
+
+    def test_xtrace_fd_ignores_test_stderr(self):
+        path = os.path.join(self.tmp.name, 'test_stderr.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    "echo '+PS4 + /fake.sh + 0S + L9 + x' >&2\n")
+        # BASH_CMD traces from the start, so 'set -x' is seen too
+        self.assertEqual(
+            shell_cov.run_test_scripts([path], jobs=1, xtrace_fd=True),
+            {path: {2, 3}})
+        self.assertEqual(
+            shell_cov.run_test_scripts([path], jobs=1),
+            {path: {3}, '/fake.sh': {9}})
+
+    def test_contexts_record_each_test(self):
+        for jobs in (1, 3):
+            contexts = shell_cov.TestContexts()
+            shell_cov.run_test_scripts([self.tmp.name], jobs=jobs,
+                                       contexts=contexts)
+            for script in self.expected():
+                self.assertEqual(contexts.covering_tests(script), [script])
+
+
+class TestRunTestScriptsAsync(unittest.TestCase):
+    setUp = TestRunTestScripts.setUp
+    expected = TestRunTestScripts.expected
+
+    def test_async_matches_threads(self):
+        with mock.patch('sys.stderr') as stderr:
+            result, failed = shell_cov.run_test_scripts_async([self.tmp.name],
+                                                              jobs=2)
+        self.assertEqual(result, self.expected())
+        self.assertEqual(list(result), sorted(result))
+        self.assertEqual(failed, [])
+        progress = ''.join(c.args[0] for c in stderr.write.call_args_list)
+        self.assertEqual(progress.count('] ok '), 3)
+        self.assertIn('[3/3] ok ', progress)
+
+    def test_async_profile_and_xtrace_fd(self):
+        profile = {}
+        with mock.patch('sys.stderr'):
+            result, _ = shell_cov.run_test_scripts_async(
+                [self.tmp.name], jobs=3, xtrace_fd=True, profile=profile)
+        # BASH_CMD traces from the start, so 'set -x' is seen too
+        self.assertEqual(result, {path: {2, 3, 4, 5}
+                                  for path in self.expected()})
+        self.assertEqual(set(profile), set(result))
+        # The sleep is charged to its line, even though the trace after it
+        # arrives in a separate read
+        for path in result:
+            seconds = {line: counts[1] for line, counts in profile[path].items()}
+            self.assertGreaterEqual(seconds[4], 0.09)
+            self.assertEqual(max(seconds, key=seconds.get), 4)
+
+    def test_async_keep_going_and_fail_fast(self):
+        path = os.path.join(self.tmp.name, 'test_0fail.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    'exit 3\n')
+        with mock.patch('sys.stderr') as stderr:
+            result, failed = shell_cov.run_test_scripts_async([self.tmp.name],
+                                                              jobs=1)
+        self.assertEqual(failed, [path])
+        self.assertEqual(result, dict(self.expected(), **{path: {3}}))
+        self.assertIn('FAILED (exit 3)', str(stderr.write.call_args_list))
+
+        with mock.patch('sys.stderr'):
+            result, failed = shell_cov.run_test_scripts_async(
+                [self.tmp.name], jobs=1, fail_fast=True)
+        # The failing test sorts first, so nothing else runs
+        self.assertEqual(failed, [path])
+        self.assertEqual(result, {path: {3}})
+
+    def test_async_timeout_keeps_lines_traced_so_far(self):
+        path = os.path.join(self.tmp.name, 'test_hang.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    'echo started\n'
+                    'sleep 60\n')
+        with mock.patch('sys.stderr') as stderr:
+            result, failed = shell_cov.run_test_scripts_async(
+                [path], timeout=0.5)
+        self.assertEqual(result, {path: {3, 4}})
+        self.assertEqual(failed, [path])
+        self.assertIn('TIMEOUT', str(stderr.write.call_args_list))
+
+    def test_async_fail_fast_keeps_lines_of_stopped_tests(self):
+        paths = []
+        for name, body in (('test_1slow.sh', 'echo slow\nsleep 5\n'),
+                           ('test_2fail.sh', 'sleep 0.2\nexit 1\n')):
+            paths.append(os.path.join(self.tmp.name, 'fast', name))
+            os.makedirs(os.path.dirname(paths[-1]), exist_ok=True)
+            with open(paths[-1], 'w') as f:
+                f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\nset -x\n" + body)
+        started = time.monotonic()
+        with mock.patch('sys.stderr') as stderr:
+            result, failed = shell_cov.run_test_scripts_async(
+                [os.path.dirname(paths[0])], jobs=2, fail_fast=True)
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertEqual(result, {paths[0]: {3, 4}, paths[1]: {3, 4}})
+        self.assertEqual(failed, [paths[1]])
+        self.assertIn('STOPPED', str(stderr.write.call_args_list))
+
+    def test_async_timeout_covers_the_whole_test(self):
+        path = os.path.join(self.tmp.name, 'test_quiet.sh')
+        with open(path, 'w') as f:
+            f.write(f"PS4='{shell_cov.DEFAULT_PS4}'\n"
+                    'set -x\n'
+                    'exec 2>/dev/null\n'
+                    'sleep 8\n')
+        started = time.monotonic()
+        with mock.patch('sys.stderr') as stderr:
+            result, failed = shell_cov.run_test_scripts_async(
+                [path], timeout=0.5)
+        self.assertLess(time.monotonic() - started, 4)
+        self.assertEqual(result, {path: {3}})
+        self.assertEqual(failed, [path])
+        self.assertIn('TIMEOUT', str(stderr.write.call_args_list))
+
+    def test_fail_fast_needs_asyncio_runner(self):
+        with mock.patch('sys.stderr'), self.assertRaises(SystemExit):
+            shell_cov.parse_args(['-t', 'tests', '--fail-fast'])
+        self.assertTrue(shell_cov.parse_args(
+            ['-t', 'tests', '--fail-fast', '--runner', 'asyncio']).fail_fast)
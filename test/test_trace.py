@@ -0,0 +1,236 @@
+import io
+import mmap
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import shell_cov.shell_cov as shell_cov
+
+TRACE = '\n'.join([
+    '+PS4 + /a/lib.sh + 0S + L1 + echo hello',
+    'hello',
+    '++PS4 + /a/lib.sh + 0S + L3 + foo',
+    '+PS4 + /a/lib.sh + 0S + L0 + bash internals',
+    '+PS4 + /b/other.sh + 1S + L7 + bar',
+    '+ not a ps4 line',
+    '+PS4 + /a/lib.sh + 1S + L1 + echo hello',
+])
+EXPECTED = {'/a/lib.sh': {1, 3}, '/b/other.sh': {7}}
+
+
+class TestTraceIngestion(unittest.TestCase):
+    def test_iter_ps4_records(self):
+        records = list(shell_cov.iter_ps4_records(TRACE.splitlines()))
+        self.assertEqual(records, [('/a/lib.sh', '0S', 1),
+                                   ('/a/lib.sh', '0S', 3),
+                                   ('/b/other.sh', '1S', 7),
+                                   ('/a/lib.sh', '1S', 1)])
+
+    def test_iter_ps4_records_from_bytes(self):
+        lines = [line.encode('utf-8') for line in TRACE.splitlines()]
+        lines.append(b'+PS4 + /a/lib.sh + 0S + L + dash has no LINENO')
+        records = list(shell_cov.iter_ps4_records(lines))
+        self.assertEqual(records, [('/a/lib.sh', b'0S', 1),
+                                   ('/a/lib.sh', b'0S', 3),
+                                   ('/b/other.sh', b'1S', 7),
+                                   ('/a/lib.sh', b'1S', 1)])
+        # Script paths are interned
+        self.assertIs(records[0][0], records[3][0])
+
+    def test_get_executed_lines_from_string(self):
+        self.assertEqual(shell_cov.get_executed_lines([('', TRACE)]),
+                         EXPECTED)
+
+    def test_get_executed_lines_from_stream(self):
+        stream = io.BytesIO(TRACE.encode('utf-8'))
+        self.assertEqual(shell_cov.get_executed_lines([('', stream)]),
+                         EXPECTED)
+
+    def test_get_executed_lines_filters(self):
+        self.assertEqual(
+            shell_cov.get_executed_lines([('', TRACE)], path_include=['/a/']),
+            {'/a/lib.sh': {1, 3}})
+        self.assertEqual(
+            shell_cov.get_executed_lines([('', TRACE)], path_ignore=['/a/']),
+            {'/b/other.sh': {7}})
+        self.assertEqual(
+            shell_cov.get_executed_lines([('', TRACE)],
+                                         path_replace=['/b/:/c/']),
+            {'/a/lib.sh': {1, 3}, '/c/other.sh': {7}})
+
+    def test_canned_results_are_streamed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            lines = TRACE.splitlines()
+            for i, chunk in enumerate((lines[:3], lines[3:])):
+                paths.append(os.path.join(tmp, f'trace{i}.txt'))
+                with open(paths[-1], 'w') as f:
+                    f.write('\n'.join(chunk))
+            result = shell_cov.get_script_lines_from_canned_results(paths)
+        self.assertEqual(result, EXPECTED)
+
+    def test_canned_results_from_a_fifo(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fifo = os.path.join(tmp, 'trace.fifo')
+            os.mkfifo(fifo)
+
+            def write():
+                with open(fifo, 'w') as f:
+                    f.write(TRACE)
+            writer = threading.Thread(target=write)
+            writer.start()
+            try:
+                result = shell_cov.get_script_lines_from_canned_results([fifo])
+            finally:
+                writer.join()
+        self.assertEqual(result, EXPECTED)
+
+    def test_file_lines_span_mapped_windows(self):
+        window = mmap.ALLOCATIONGRANULARITY
+        lines = [b'+PS4 + /a/x.sh + L1\n', b'x' * (window * 2) + b'\n',
+                 b'y' * (window - 5) + b'\n', b'+PS4 + /a/x.sh + L2']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.txt')
+            with open(path, 'wb') as f:
+                f.write(b''.join(lines))
+            self.assertEqual(
+                list(shell_cov._iter_file_lines(path, window)), lines)
+            open(path, 'wb').close()
+            self.assertEqual(list(shell_cov._iter_file_lines(path)), [])
+
+    def test_file_line_ranges_partition_the_file(self):
+        lines = [f'+PS4 + /a/x.sh + 0S + L{i}\n'.encode() * (i % 3)
+                 for i in range(200)]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.txt')
+            with open(path, 'wb') as f:
+                f.write(b''.join(lines))
+            size = os.path.getsize(path)
+            for step in (1, 7, 100, size):
+                ranges = [shell_cov._iter_file_lines(path, start=start,
+                                                     stop=start + step)
+                          for start in range(0, size, step)]
+                self.assertEqual(b''.join(b''.join(r) for r in ranges),
+                                 b''.join(lines))
+
+    def test_parallel_canned_results_match_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, 'big.txt'),
+                     os.path.join(tmp, 'small.txt'),
+                     os.path.join(tmp, 'trace.bin')]
+            with open(paths[0], 'w') as f:
+                for i in range(5000):
+                    f.write(f'+PS4 + /a/s{i % 7}.sh + 0S + L{i % 301} + x\n')
+            with open(paths[1], 'w') as f:
+                f.write(TRACE)
+            shell_cov.write_binary_trace(paths[2], {'/c/more.sh': {2}})
+            serial = shell_cov.get_script_lines_from_canned_results(
+                paths, path_ignore=['/b/'])
+            with mock.patch.object(shell_cov, 'CANNED_SHARD_SIZE', 4096):
+                self.assertGreater(
+                    len(shell_cov._split_canned_results(paths, 2)), 3)
+                parallel = shell_cov.get_script_lines_from_canned_results(
+                    paths, path_ignore=['/b/'], jobs=2)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(serial), 9)
+
+    def test_profile(self):
+        trace = '\n'.join([
+            '+PS4 + /a/lib.sh + 10.5S + L1 + slow',
+            '+PS4 + /a/lib.sh + 12.0S + L2 + fast',
+            '+PS4 + /b/other.sh + 12,25S + L1 + other',
+            '+PS4 + /a/lib.sh + 13S + L2 + fast',
+            '+PS4 + /a/lib.sh + S + L1 + no clock',
+        ])
+        profile = {}
+        lines = shell_cov.get_executed_lines([('', trace), ('', trace)],
+                                             path_ignore=['/b/'],
+                                             profile=profile)
+        self.assertEqual(lines, {'/a/lib.sh': {1, 2}})
+        self.assertEqual(profile, {'/a/lib.sh': {1: [4, 3.0],
+                                                 2: [4, 0.5]}})
+
+    def test_canned_profile_in_parallel(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'trace.txt')
+            with open(path, 'w') as f:
+                f.write(TRACE)
+            for jobs in (1, 2):
+                profile = {}
+                shell_cov.get_script_lines_from_canned_results(
+                    [path, path], jobs=jobs, profile=profile)
+                self.assertEqual(profile['/a/lib.sh'][1][0], 4)
+                self.assertEqual(profile['/b/other.sh'], {7: [2, 0.0]})
+
+    def test_profile_info(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            script = os.path.join(tmp, 'lib.sh')
+            with open(script, 'w') as f:
+                f.write('f() {\n  sleep 1\n}\nf\n')
+            lines, functions = shell_cov.get_profile_info(
+                {script: {2: [1, 1.0], 4: [2, 0.0], 1: [1, 0.0]}}, limit=2)
+        self.assertEqual(lines[1:], [[script, '2', '1', '1.000000'],
+                                     [script, '4', '2', '0.000000']])
+        self.assertEqual(functions[1:], [[script, 'f (L1)', '2', '1.000000']])
+
+
+class TestBinaryTrace(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.binary = os.path.join(self.tmp.name, 'trace.bin')
+        self.text = os.path.join(self.tmp.name, 'trace.txt')
+        with open(self.text, 'w') as f:
+            f.write(TRACE)
+
+    def test_round_trip(self):
+        script_lines = {'/a/lib.sh': {5, 1, 300000}, '/ü/other.sh': set()}
+        shell_cov.write_binary_trace(self.binary, script_lines)
+        self.assertTrue(shell_cov.is_binary_trace(self.binary))
+        self.assertFalse(shell_cov.is_binary_trace(self.text))
+        self.assertEqual(shell_cov.read_binary_trace(self.binary),
+                         script_lines)
+
+    def test_canned_results_accept_binary_traces(self):
+        shell_cov.write_binary_trace(self.binary, {'/c/more.sh': {2},
+                                                   '/a/lib.sh': {4}})
+        result = shell_cov.get_script_lines_from_canned_results(
+            [self.text, self.binary], path_ignore=['/b/'])
+        self.assertEqual(result, {'/a/lib.sh': {1, 3, 4}, '/c/more.sh': {2}})
+
+    def test_newer_format_is_rejected(self):
+        with open(self.binary, 'wb') as f:
+            f.write(shell_cov.BINARY_MAGIC + b'\xff\xff')
+        with self.assertRaises(ValueError):
+            shell_cov.read_binary_trace(self.binary)
+
+
+class TestPathFilter(unittest.TestCase):
+    def test_rules(self):
+        path_filter = shell_cov.PathFilter(['/lib/', '/bin/'], ['skip'],
+                                           ['/lib/:/new/', '/new/x:/y'])
+        self.assertEqual(path_filter('/a/lib/x.sh'), '/a/y.sh')
+        self.assertEqual(path_filter('/a/bin/x.sh'), '/a/bin/x.sh')
+        self.assertIsNone(path_filter('/a/bin/skip.sh'))
+        self.assertIsNone(path_filter('/a/other/x.sh'))
+
+    def test_special_characters_are_literal(self):
+        path_filter = shell_cov.PathFilter(['a.b', '(c'])
+        self.assertEqual(path_filter('/a.b/x'), '/a.b/x')
+        self.assertEqual(path_filter('/(c/x'), '/(c/x')
+        self.assertIsNone(path_filter('/axb/x'))
+
+    def test_empty_include_matches_nothing(self):
+        self.assertIsNone(shell_cov.PathFilter([])('/a/x.sh'))
+        self.assertEqual(shell_cov.PathFilter()('/a/x.sh'), '/a/x.sh')
+
+    def test_decision_is_memoised(self):
+        path_filter = shell_cov.PathFilter(['/a/'])
+        with mock.patch.object(path_filter, '_decide',
+                               wraps=path_filter._decide) as decide:
+            for _ in range(3):
+                path_filter('/a/x.sh')
+                path_filter('/b/x.sh')
+        self.assertEqual(decide.call_count, 2)